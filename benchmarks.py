@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the notification hot paths.
+
+Seeds an in-memory database and measures throughput, latency percentiles,
+query counts and peak memory of ``send_now``, ``queue``,
+``engine.send_all`` and ``NoticeSettingsView``. Results are written as JSON
+so runs of different versions can be compared:
+
+    python benchmarks.py --users 1000 --output before.json
+    python benchmarks.py --users 1000 --output after.json --compare before.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import django
+
+from django.conf import settings
+
+from runtests import DEFAULT_SETTINGS, PACKAGE_ROOT
+
+
+def bench_settings(options):
+    templates = {}
+    for i in range(options.notice_types):
+        templates["pinax/notifications/bench_{0}/subject.txt".format(i)] = "{{ notice }}"
+        templates["pinax/notifications/bench_{0}/body.html".format(i)] = (
+            "<h1>{{ notice }}</h1><p>Hello {{ recipient }}, see {{ base_url }}.</p>"
+        )
+    backends = [
+        ("email" if i == 0 else "email{0}".format(i), "pinax.notifications.backends.email.EmailBackend")
+        for i in range(options.media)
+    ]
+    return dict(
+        DEFAULT_SETTINGS,
+        EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+        PINAX_NOTIFICATIONS_BACKENDS=backends,
+        TEMPLATES=[
+            {
+                "BACKEND": "django.template.backends.django.DjangoTemplates",
+                "DIRS": [os.path.join(PACKAGE_ROOT, "templates")],
+                "OPTIONS": {
+                    "loaders": [
+                        ("django.template.loaders.locmem.Loader", templates),
+                        "django.template.loaders.filesystem.Loader",
+                        "django.template.loaders.app_directories.Loader",
+                    ],
+                },
+            },
+        ],
+    )
+
+
+def seed(options):
+    from django.contrib.auth import get_user_model
+    from pinax.notifications.models import NoticeType, NoticeSetting, NOTICE_MEDIA
+
+    User = get_user_model()
+    User.objects.bulk_create([
+        User(username="bench_{0}".format(i), email="bench_{0}@example.com".format(i))
+        for i in range(options.users)
+    ])
+    NoticeType.objects.bulk_create([
+        NoticeType(label="bench_{0}".format(i), display="Bench {0}".format(i),
+                   description="benchmark notice", default=2)
+        for i in range(options.notice_types)
+    ])
+    users = list(User.objects.order_by("pk"))
+    notice_types = list(NoticeType.objects.order_by("pk"))
+    seeded = users[:int(len(users) * options.settings_ratio)]
+    NoticeSetting.objects.bulk_create([
+        NoticeSetting(user=user, notice_type=notice_type, medium=medium_id, send=True)
+        for user in seeded
+        for notice_type in notice_types
+        for medium_id, _ in NOTICE_MEDIA
+    ], batch_size=500)
+    return users, notice_types
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def measure(name, func, repeat, items, setup=None, teardown=None):
+    """
+    Runs ``func`` ``repeat`` times for timings, then once more to count
+    queries and once more under tracemalloc for peak memory.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    def run(wrapper=None):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        if wrapper is None:
+            func()
+        else:
+            with wrapper:
+                func()
+        elapsed = time.perf_counter() - start
+        if teardown is not None:
+            teardown()
+        return elapsed
+
+    timings = [run() for _ in range(repeat)]
+    queries = CaptureQueriesContext(connection)
+    run(queries)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    total = sum(timings)
+    result = {
+        "items": items,
+        "repeat": repeat,
+        "throughput": items * repeat / total if total else None,
+        "latency": {
+            "mean": total / repeat,
+            "p50": percentile(timings, 50),
+            "p90": percentile(timings, 90),
+            "p99": percentile(timings, 99),
+        },
+        "queries": len(queries.captured_queries),
+        "peak_memory": peak,
+    }
+    print("{0:<20} {1:>10.1f} items/s  p50 {2:.4f}s  {3:>6} queries  {4:>10} bytes".format(
+        name, result["throughput"] or 0, result["latency"]["p50"], result["queries"], peak))
+    return result
+
+
+def run_benchmarks(options):
+    from django.core import mail
+    from django.test import RequestFactory
+    from django.contrib.auth import get_user_model
+
+    from pinax.notifications import engine
+    from pinax.notifications.models import NoticeQueueBatch, send_now, queue, NOTICE_MEDIA
+    from pinax.notifications.views import NoticeSettingsView
+
+    users, notice_types = seed(options)
+    label = notice_types[0].label
+    lock_dir = tempfile.mkdtemp()
+    lock_path = os.path.join(lock_dir, "send_notices")
+
+    def clear_outbox():
+        mail.outbox = []
+
+    def clear_queue():
+        NoticeQueueBatch.objects.all().delete()
+        mail.outbox = []
+
+    results = {}
+    results["send_now"] = measure(
+        "send_now", lambda: send_now(users, label), options.repeat, len(users),
+        teardown=clear_outbox)
+    results["queue"] = measure(
+        "queue", lambda: queue(get_user_model().objects.all(), label), options.repeat, len(users),
+        teardown=clear_queue)
+    results["send_all"] = measure(
+        "send_all", lambda: engine.send_all(lock_path), options.repeat, len(users),
+        setup=lambda: queue(get_user_model().objects.all(), label), teardown=clear_queue)
+
+    factory = RequestFactory()
+    user = users[-1]
+
+    def settings_get():
+        request = factory.get("/notifications/settings/")
+        request.user = user
+        NoticeSettingsView.as_view()(request).render()
+
+    posts = itertools.count()
+
+    def settings_post():
+        # alternate the enabled half so that every run actually writes
+        enabled = notice_types[next(posts) % 2::2]
+        data = {
+            "setting-{0}-{1}".format(notice_type.pk, medium_id): "on"
+            for notice_type in enabled
+            for medium_id, _ in NOTICE_MEDIA
+        }
+        request = factory.post("/notifications/settings/", data)
+        request.user = user
+        NoticeSettingsView.as_view()(request)
+
+    cells = len(notice_types) * len(NOTICE_MEDIA)
+    results["settings_view_get"] = measure(
+        "settings_view_get", settings_get, options.repeat, cells)
+    results["settings_view_post"] = measure(
+        "settings_view_post", settings_post, options.repeat, cells)
+
+    shutil.rmtree(lock_dir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline):
+    print("")
+    print("{0:<20} {1:>12} {2:>12} {3:>10}".format("", "throughput", "p50", "queries"))
+    for name, result in sorted(results.items()):
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+
+        def change(new, old):
+            if not old or new is None:
+                return "n/a"
+            return "{0:+.1f}%".format((new - old) * 100.0 / old)
+        print("{0:<20} {1:>12} {2:>12} {3:>10}".format(
+            name,
+            change(result["throughput"], previous["throughput"]),
+            change(result["latency"]["p50"], previous["latency"]["p50"]),
+            "{0:+d}".format(result["queries"] - previous["queries"]),
+        ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--notice-types", type=int, default=10)
+    parser.add_argument("--media", type=int, default=1)
+    parser.add_argument("--settings-ratio", type=float, default=0.5,
+                        help="fraction of users with NoticeSettings seeded for every type and medium")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    options = parser.parse_args(argv)
+
+    if not settings.configured:
+        settings.configure(**bench_settings(options))
+    django.setup()
+
+    from django.core.management import call_command
+    call_command("migrate", verbosity=0, interactive=False)
+
+    from pinax.notifications import __version__
+
+    results = run_benchmarks(options)
+    report = {
+        "meta": {
+            "version": __version__,
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "timestamp": time.time(),
+            "parameters": vars(options),
+        },
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as fp:
+            compare(results, json.load(fp))
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,16 +1,26 @@
 from django.contrib import admin
 
-from .models import NoticeType, NoticeQueueBatch, NoticeSetting
+from .models import NoticeType, NoticeQueueBatch, NoticeSetting, StoredNotice
 
 
 class NoticeTypeAdmin(admin.ModelAdmin):
     list_display = ["label", "display", "description", "default"]
 
 
+class NoticeQueueBatchAdmin(admin.ModelAdmin):
+    list_display = ["id", "label", "recipient_count", "priority", "created_at"]
+
+
 class NoticeSettingAdmin(admin.ModelAdmin):
     list_display = ["id", "user", "notice_type", "medium", "scoping", "send"]
 
 
-admin.site.register(NoticeQueueBatch)
+class StoredNoticeAdmin(admin.ModelAdmin):
+    list_display = ["id", "recipient", "notice_type", "added", "unread"]
+    raw_id_fields = ["recipient", "sender"]
+
+
+admin.site.register(NoticeQueueBatch, NoticeQueueBatchAdmin)
 admin.site.register(NoticeType, NoticeTypeAdmin)
 admin.site.register(NoticeSetting, NoticeSettingAdmin)
+admin.site.register(StoredNotice, StoredNoticeAdmin)
@@ -0,0 +1,167 @@
+import operator
+
+from functools import reduce
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.query import QuerySet
+
+from django.contrib.auth import get_user_model
+
+from .conf import settings, load_path_attr
+from .utils import chunked, load_media_defaults, _scoping_kwargs
+
+
+registry = {}
+
+
+def register(name):
+    """
+    Registers an audience function under ``name``.
+
+    An audience function takes the arguments stored in an ``Audience`` and
+    returns a QuerySet (or any iterable) of users::
+
+        @audiences.register("thread_subscribers")
+        def thread_subscribers(thread_id):
+            return User.objects.filter(subscriptions__thread_id=thread_id)
+    """
+    def decorator(func):
+        registry[name] = func
+        return func
+    return decorator
+
+
+def get_audience_function(name):
+    if name in registry:
+        return registry[name]
+    if "." in name:
+        return load_path_attr(name)
+    raise ImproperlyConfigured("'{0}' is not a registered audience".format(name))
+
+
+class Audience(object):
+    """
+    A serializable description of a set of recipients.
+
+    Only the audience name and its arguments are stored when queued; the
+    recipients are resolved lazily, in chunks, when the queue is emitted.
+    ``name`` is either a name passed to ``register`` or the dotted path of an
+    audience function.
+
+    ``media`` and ``scoping`` restrict how the audience is notified: only
+    the backends of ``media`` (all of them when None) are used and settings
+    are resolved for ``scoping``.
+    """
+
+    media = None
+    scoping = None
+
+    def __init__(self, name, *args, **kwargs):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+
+    @classmethod
+    def filter(cls, **lookups):
+        """
+        An audience of every user matching ``lookups``.
+        """
+        return cls("users", **lookups)
+
+    @classmethod
+    def subscribers(cls, label, medium=None, scoping=None):
+        """
+        An audience of every user opted in to the notice type ``label`` on
+        ``medium`` (on any medium when None), notified on that medium only.
+        """
+        audience = cls("subscribers", label, medium=medium, scoping=scoping)
+        if medium is not None:
+            audience.media = [medium]
+        audience.scoping = scoping
+        return audience
+
+    def __repr__(self):
+        return "<Audience {0} args={1!r} kwargs={2!r}>".format(self.name, self.args, self.kwargs)
+
+    def key(self):
+        return (self.name, self.args, self.kwargs, self.media, self.scoping)
+
+    def __eq__(self, other):
+        return isinstance(other, Audience) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def resolve(self):
+        return get_audience_function(self.name)(*self.args, **self.kwargs)
+
+    def chunks(self, chunk_size=None):
+        """
+        Yields lists of at most ``chunk_size`` users.
+
+        QuerySets are walked by primary key so each chunk is a separate,
+        bounded query.
+        """
+        if chunk_size is None:
+            chunk_size = settings.PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE
+        users = self.resolve()
+        if isinstance(users, QuerySet):
+            users = users.order_by("pk")
+            last_pk = None
+            while True:
+                qs = users if last_pk is None else users.filter(pk__gt=last_pk)
+                chunk = list(qs[:chunk_size])
+                if not chunk:
+                    return
+                yield chunk
+                last_pk = chunk[-1].pk
+        else:
+            for chunk in chunked(users, chunk_size):
+                yield chunk
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            for user in chunk:
+                yield user
+
+
+@register("users")
+def users(**lookups):
+    return get_user_model()._default_manager.filter(**lookups)
+
+
+@register("subscribers")
+def subscribers(label, medium=None, scoping=None):
+    """
+    Users opted in to the notice type ``label`` on ``medium``, or on any
+    medium when None, either explicitly or by the notice type's default, in
+    a single query. Permissions are checked when notices are delivered.
+
+    The subscription index is not used here: its bitsets cannot be tested in
+    SQL, and scanning every user's row would be slower than this query.
+    """
+    from .models import NoticeSetting, NoticeType
+
+    media, defaults = load_media_defaults()
+    media = [medium] if medium is not None else [key[0] for key in media]
+    _, scoping_lookup = _scoping_kwargs(scoping)
+    notice_settings = NoticeSetting.objects.filter(
+        user=OuterRef("pk"), notice_type__label=label, **scoping_lookup)
+
+    annotations, conditions = {}, []
+    for i, medium in enumerate(media):
+        enabled, configured, default = ["_{0}_{1}".format(name, i) for name in (
+            "enabled", "configured", "default")]
+        annotations[enabled] = Exists(notice_settings.filter(medium=medium, send=True))
+        annotations[configured] = Exists(notice_settings.filter(medium=medium))
+        annotations[default] = Exists(
+            NoticeType.objects.filter(label=label, default__gte=defaults[medium]))
+        # users without a setting get the notice type's default
+        conditions.append(
+            Q(**{enabled: True}) | Q(**{configured: False, default: True})
+        )
+    User = get_user_model()
+    if not conditions:
+        return User._default_manager.none()
+    return User._default_manager.annotate(**annotations).filter(reduce(operator.or_, conditions))
@@ -2,6 +2,7 @@ from django.template.loader import render_to_string
 
 from django.contrib.sites.models import Site
 
+from .. import metrics
 from ..conf import settings
 from ..utils import notice_setting_for_user
 
@@ -29,17 +30,26 @@ class BaseBackend(object):
         """
         raise NotImplementedError()
 
+    def deliver_many(self, recipients, sender, notice_type, extra_context):
+        """
+        Deliver a notification to each of the given recipients, all of whom
+        may be sent to. Backends able to send in bulk should override this.
+        """
+        for recipient in recipients:
+            self.deliver(recipient, sender, notice_type, extra_context)
+
     def get_formatted_messages(self, formats, label, context):
         """
         Returns a dictionary with the format identifier as the key. The values are
         are fully rendered templates with the given context.
         """
         format_templates = {}
-        for fmt in formats:
-            format_templates[fmt] = render_to_string(
-                ["pinax/notifications/{0}/{1}".format(label, fmt),
-                 "pinax/notifications/{0}".format(fmt)],
-                context)
+        with metrics.timer("render", label=label, backend=self.medium_id):
+            for fmt in formats:
+                format_templates[fmt] = render_to_string(
+                    ["pinax/notifications/{0}/{1}".format(label, fmt),
+                     "pinax/notifications/{0}".format(fmt)],
+                    context)
         return format_templates
 
     def get_context(self, *args, **kwargs):
@@ -1,15 +1,27 @@
-from django.conf import settings
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
+import hashlib
+import re
+
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template import TemplateDoesNotExist
+from django.template.loader import get_template, render_to_string
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext
 from html2text import html2text
 
+from .. import metrics
+from ..cache import LRUCache
+from ..conf import settings
 from .base import BaseBackend
 
 
 class EmailBackend(BaseBackend):
     spam_sensitivity = 2
 
+    @cached_property
+    def plaintext_cache(self):
+        size = settings.PINAX_NOTIFICATIONS_EMAIL_PLAINTEXT_CACHE_SIZE
+        return LRUCache(size) if size else None
+
     def can_send(self, user, notice_type, scoping):
         can_send = super(EmailBackend, self).can_send(user, notice_type, scoping)
         if can_send and user.email:
@@ -34,9 +46,122 @@ class EmailBackend(BaseBackend):
         return render_to_string(
             'pinax/notifications/{}/body.html'.format(label), context)
 
+    def get_text_body(self, label, context, body):
+        """
+        Renders ``body.txt`` when text templates are enabled and one exists,
+        otherwise converts the HTML body.
+        """
+        if settings.PINAX_NOTIFICATIONS_EMAIL_TEXT_TEMPLATES:
+            try:
+                return render_to_string(
+                    'pinax/notifications/{}/body.txt'.format(label), context)
+            except TemplateDoesNotExist:
+                pass
+        return self.html_to_text(body)
+
+    def html_to_text(self, body):
+        """
+        ``html2text`` memoized by a hash of the body, since broadcast
+        notices often render identical bodies.
+        """
+        if self.plaintext_cache is None:
+            return html2text(body)
+        key = hashlib.sha1(body.encode("utf-8")).digest()
+        text = self.plaintext_cache.get(key)
+        if text is None:
+            text = html2text(body)
+            self.plaintext_cache.set(key, text)
+        return text
+
+    def template_names(self, label):
+        names = ["subject.txt", "body.html"]
+        if settings.PINAX_NOTIFICATIONS_EMAIL_TEXT_TEMPLATES:
+            names.append("body.txt")
+        return ["pinax/notifications/{}/{}".format(label, name) for name in names]
+
+    @cached_property
+    def detected_invariant(self):
+        return {}
+
+    def is_recipient_invariant(self, notice_type):
+        """
+        Whether the templates of ``notice_type`` render the same for every
+        recipient, either as declared by the notice type or, with
+        ``PINAX_NOTIFICATIONS_EMAIL_DETECT_RECIPIENT_INVARIANT``, because
+        their source never mentions the recipient.
+        """
+        if notice_type.recipient_invariant:
+            return True
+        if not settings.PINAX_NOTIFICATIONS_EMAIL_DETECT_RECIPIENT_INVARIANT:
+            return False
+        label = notice_type.label
+        if label not in self.detected_invariant:
+            self.detected_invariant[label] = all(
+                template_is_recipient_invariant(name) for name in self.template_names(label)
+            )
+        return self.detected_invariant[label]
+
+    def render(self, recipient, sender, notice_type, extra_context):
+        """
+        Returns the subject, plain text and HTML body of a notice.
+        """
+        tags = {"label": notice_type.label, "backend": self.medium_id}
+        with metrics.timer("get_context", **tags):
+            context = self.get_context(recipient, sender, notice_type, extra_context)
+        with metrics.timer("render", **tags):
+            subject = self.get_subject(notice_type.label, context)
+            body = self.get_body(notice_type.label, context)
+            text = self.get_text_body(notice_type.label, context, body)
+        return subject, text, body
+
+    def build_message(self, recipient, subject, text, body):
+        message = EmailMultiAlternatives(
+            subject, text, settings.DEFAULT_FROM_EMAIL, [recipient.email])
+        message.attach_alternative(body, "text/html")
+        return message
+
+    def get_message(self, recipient, sender, notice_type, extra_context):
+        return self.build_message(
+            recipient, *self.render(recipient, sender, notice_type, extra_context))
+
+    def get_messages(self, recipients, sender, notice_type, extra_context):
+        """
+        Renders a message for each recipient. Recipient invariant notices
+        are rendered once, without a recipient, and the output shared.
+        """
+        if len(recipients) > 1 and self.is_recipient_invariant(notice_type):
+            rendered = self.render(None, sender, notice_type, extra_context)
+            return [self.build_message(recipient, *rendered) for recipient in recipients]
+        return [
+            self.get_message(recipient, sender, notice_type, extra_context)
+            for recipient in recipients
+        ]
+
     def deliver(self, recipient, sender, notice_type, extra_context):
-        context = self.get_context(recipient, sender, notice_type, extra_context)
-        subject = self.get_subject(notice_type.label, context)
-        body = self.get_body(notice_type.label, context)
-        send_mail(subject, html2text(body), settings.DEFAULT_FROM_EMAIL,
-                  [recipient.email], fail_silently=False, html_message=body)
+        self.deliver_many([recipient], sender, notice_type, extra_context)
+
+    def deliver_many(self, recipients, sender, notice_type, extra_context):
+        """
+        Sends every message over a single connection. Subclasses overriding
+        ``deliver`` get it called for each recipient instead, as before.
+        """
+        if type(self).deliver is not EmailBackend.deliver:
+            return super(EmailBackend, self).deliver_many(recipients, sender, notice_type, extra_context)
+        messages = self.get_messages(recipients, sender, notice_type, extra_context)
+        get_connection(fail_silently=False).send_messages(messages)
+
+
+# a mention of the recipient, or a tag pulling in another template
+RECIPIENT_DEPENDENT = re.compile(r"\brecipient\b|{%\s*(?:extends|include)\b")
+
+
+def template_is_recipient_invariant(name):
+    """
+    A conservative check that the template ``name`` does not use the
+    recipient: custom tags reading it from the context are not detected.
+    """
+    try:
+        template = get_template(name)
+    except TemplateDoesNotExist:
+        return True
+    return not RECIPIENT_DEPENDENT.search(template.template.source)
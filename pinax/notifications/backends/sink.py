@@ -0,0 +1,179 @@
+"""
+A backend that renders notices like the email backend but, instead of
+sending them, appends them to a local file or keeps them in memory. It is
+meant for load testing: plugged into ``PINAX_NOTIFICATIONS_BACKENDS`` it
+measures everything but the transport::
+
+    PINAX_NOTIFICATIONS_BACKENDS = [
+        ("sink", "pinax.notifications.backends.sink.SinkBackend"),
+    ]
+    PINAX_NOTIFICATIONS_SINK_OPTIONS = {"path": "/tmp/notices.jsonl"}
+
+Without a ``path`` the last ``ring_size`` messages are kept in memory.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import deque
+
+from django.utils.functional import cached_property
+
+from .. import metrics
+from ..conf import settings
+from .base import BaseBackend
+from .email import EmailBackend
+
+
+class SinkBackend(EmailBackend):
+    """
+    Writes rendered messages as JSON lines to ``path``, rotated once it
+    grows past ``max_bytes`` and keeping ``backup_count`` old files, through
+    a write buffer of ``buffer_size`` bytes.
+    """
+
+    def __init__(self, medium_id, spam_sensitivity=None):
+        super(SinkBackend, self).__init__(medium_id, spam_sensitivity)
+        self.lock = threading.Lock()
+        self.stream = None
+        self.size = 0
+        self.count = 0
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+
+    # backends are created while the settings are still being configured,
+    # so the options are only read on first use
+
+    @cached_property
+    def options(self):
+        return settings.PINAX_NOTIFICATIONS_SINK_OPTIONS
+
+    @cached_property
+    def path(self):
+        return self.options.get("path")
+
+    @cached_property
+    def max_bytes(self):
+        return self.options.get("max_bytes", 64 * 1024 * 1024)
+
+    @cached_property
+    def backup_count(self):
+        return self.options.get("backup_count", 5)
+
+    @cached_property
+    def buffer_size(self):
+        return self.options.get("buffer_size", 1024 * 1024)
+
+    @cached_property
+    def messages(self):
+        return deque(maxlen=self.options.get("ring_size", 10000))
+
+    def can_send(self, user, notice_type, scoping):
+        # unlike email, recipients without an address are still rendered
+        return BaseBackend.can_send(self, user, notice_type, scoping)
+
+    def deliver(self, recipient, sender, notice_type, extra_context):
+        self.deliver_many([recipient], sender, notice_type, extra_context)
+
+    def deliver_many(self, recipients, sender, notice_type, extra_context):
+        with self.lock:
+            if self.started is None:
+                self.started = time.time()
+        records = [
+            {
+                "label": notice_type.label,
+                "to": message.to,
+                "subject": message.subject,
+                "body": message.body,
+                "html": message.alternatives[0][0],
+            }
+            for message in self.get_messages(recipients, sender, notice_type, extra_context)
+        ]
+        self.write(records)
+
+    def write(self, records):
+        with self.lock:
+            if self.path is None:
+                self.messages.extend(records)
+            else:
+                data = "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+                self.write_bytes(data)
+                self.bytes += len(data)
+            self.count += len(records)
+            self.finished = time.time()
+        metrics.incr("sink_messages", len(records), backend=self.medium_id)
+
+    def write_bytes(self, data):
+        if self.stream is None:
+            self.open()
+        elif self.size + len(data) > self.max_bytes and self.size:
+            self.rotate()
+        self.stream.write(data)
+        self.size += len(data)
+
+    def open(self):
+        self.stream = open(self.path, "ab", buffering=self.buffer_size)
+        self.size = self.stream.tell()
+        atexit.register(self.close)
+
+    def rotate(self):
+        self.stream.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            source = "{0}.{1}".format(self.path, i)
+            if os.path.exists(source):
+                os.replace(source, "{0}.{1}".format(self.path, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, "{0}.1".format(self.path))
+        else:
+            os.remove(self.path)
+        self.stream = open(self.path, "ab", buffering=self.buffer_size)
+        self.size = 0
+
+    def flush(self):
+        with self.lock:
+            if self.stream is not None:
+                self.stream.flush()
+
+    def close(self):
+        with self.lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+                atexit.unregister(self.close)
+        if self.count:
+            logging.info(self.report())
+
+    def reset(self):
+        """
+        Clears the throughput figures and the in-memory messages.
+        """
+        self.messages.clear()
+        self.count = 0
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+
+    def stats(self):
+        """
+        Returns the messages and bytes written and the rate at which they
+        were rendered and written, from the first delivery to the last write.
+        """
+        seconds = (self.finished - self.started) if self.started is not None else 0
+        return {
+            "messages": self.count,
+            "bytes": self.bytes,
+            "seconds": seconds,
+            "messages_per_second": self.count / seconds if seconds else None,
+            "bytes_per_second": self.bytes / seconds if seconds else None,
+        }
+
+    def report(self):
+        stats = self.stats()
+        rate = stats["messages_per_second"]
+        return "{0} sink: {1} messages, {2} bytes in {3:.2f} seconds ({4})".format(
+            self.medium_id, stats["messages"], stats["bytes"], stats["seconds"],
+            "{0:.1f} messages/s".format(rate) if rate is not None else "n/a")
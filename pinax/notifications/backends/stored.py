@@ -0,0 +1,68 @@
+"""
+A backend storing notices in the database for display on site::
+
+    PINAX_NOTIFICATIONS_BACKENDS = [
+        ("email", "pinax.notifications.backends.email.EmailBackend"),
+        ("on_site", "pinax.notifications.backends.stored.StoredBackend"),
+    ]
+
+Notices are listed with ``StoredNotice.for_user``, counted with
+``StoredNotice.unread_count`` and marked read with ``StoredNotice.mark_read``.
+"""
+from django.db import transaction
+from django.utils.translation import ugettext
+
+from django.contrib.auth import get_user_model
+
+from .base import BaseBackend
+
+
+class StoredBackend(BaseBackend):
+    """
+    Renders ``full.html`` for each recipient and inserts the notices in bulk,
+    bumping the recipients' unread counters in the same transaction.
+    """
+    spam_sensitivity = 1
+
+    def get_context(self, recipient, sender, notice_type, extra_context):
+        context = super(StoredBackend, self).get_context()
+        context.update({
+            "recipient": recipient,
+            "sender": sender,
+            "notice": ugettext(notice_type.display),
+        })
+        context.update(extra_context)
+        return context
+
+    def get_message(self, recipient, sender, notice_type, extra_context):
+        context = self.get_context(recipient, sender, notice_type, extra_context)
+        return self.get_formatted_messages(["full.html"], notice_type.label, context)["full.html"]
+
+    def deliver(self, recipient, sender, notice_type, extra_context):
+        self.deliver_many([recipient], sender, notice_type, extra_context)
+
+    def deliver_many(self, recipients, sender, notice_type, extra_context):
+        # backends are loaded by the settings, before the models
+        from ..models import NoticeCounter, StoredNotice
+
+        if notice_type.recipient_invariant:
+            message = self.get_message(None, sender, notice_type, extra_context)
+            messages = [message] * len(recipients)
+        else:
+            messages = [
+                self.get_message(recipient, sender, notice_type, extra_context)
+                for recipient in recipients
+            ]
+        # the sender may be anything, only users are stored
+        sender_id = sender.pk if isinstance(sender, get_user_model()) else None
+        with transaction.atomic():
+            StoredNotice.objects.bulk_create([
+                StoredNotice(
+                    recipient=recipient,
+                    sender_id=sender_id,
+                    notice_type=notice_type,
+                    message=message
+                )
+                for recipient, message in zip(recipients, messages)
+            ])
+            NoticeCounter.increment(recipient.pk for recipient in recipients)
@@ -0,0 +1,260 @@
+"""
+A backend POSTing notices as JSON to an HTTP endpoint::
+
+    PINAX_NOTIFICATIONS_BACKENDS = [
+        ("webhook", "pinax.notifications.backends.webhook.WebhookBackend"),
+    ]
+    PINAX_NOTIFICATIONS_WEBHOOK_OPTIONS = {"url": "https://hooks.example.com/notices"}
+
+Each request carries up to ``batch_size`` notices as
+``{"notices": [...]}`` over a pool of keep-alive connections.
+"""
+import atexit
+import json
+import logging
+import threading
+import time
+
+from http import client as http_client
+from queue import Empty, Full, LifoQueue
+from urllib.parse import urlsplit
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import cached_property
+from django.utils.translation import ugettext
+
+from .. import metrics
+from ..conf import settings
+from .base import BaseBackend
+
+
+class WebhookError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to ``size`` idle keep-alive connections to a single host.
+    """
+
+    def __init__(self, url, size, timeout):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ImproperlyConfigured("webhook url must be an http or https url")
+        self.connection_class = (
+            http_client.HTTPSConnection if parts.scheme == "https" else http_client.HTTPConnection
+        )
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or "/"
+        if parts.query:
+            self.path += "?" + parts.query
+        self.timeout = timeout
+        self.idle = LifoQueue(size)
+
+    def connect(self):
+        return self.connection_class(self.host, self.port, timeout=self.timeout)
+
+    def put(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except Full:
+            conn.close()
+
+    def request(self, body, headers):
+        """
+        POSTs ``body`` and returns the response status, reusing an idle
+        connection when the server kept it open.
+        """
+        try:
+            conn = self.idle.get_nowait()
+        except Empty:
+            return self.send(self.connect(), body, headers)
+        try:
+            return self.send(conn, body, headers)
+        except (http_client.BadStatusLine, ConnectionError):
+            # the server closed the idle connection in the meantime: not a
+            # failed attempt, so retry right away on a new connection
+            return self.send(self.connect(), body, headers)
+
+    def send(self, conn, body, headers):
+        try:
+            conn.request("POST", self.path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self.put(conn)
+        return response.status
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Empty:
+                return
+
+
+class WebhookBackend(BaseBackend):
+    """
+    Options, from ``PINAX_NOTIFICATIONS_WEBHOOK_OPTIONS``:
+
+    * ``url`` - the endpoint
+    * ``batch_size`` - notices per request
+    * ``flush_interval`` - how many milliseconds an incomplete batch may wait
+      for more notices; by default it is sent at the end of each delivery
+    * ``timeout`` - the connect and read timeout in seconds
+    * ``retries`` - how many times a failed request is retried
+    * ``backoff`` - seconds before the first retry, doubled for each one
+    * ``pool_size`` - how many idle connections are kept open
+    * ``headers`` - extra request headers, e.g. for authentication
+    * ``formats`` - the templates rendered for each notice
+    """
+
+    spam_sensitivity = 2
+    retry_statuses = (429, 502, 503, 504)
+
+    def __init__(self, medium_id, spam_sensitivity=None):
+        super(WebhookBackend, self).__init__(medium_id, spam_sensitivity)
+        self.pending = []
+        self.lock = threading.RLock()
+        self.timer = None
+        # whether the notices left in pending failed to be sent by the timer
+        self.failed = False
+        atexit.register(self.flush)
+
+    @cached_property
+    def options(self):
+        # not read in __init__: the settings are not fully configured yet
+        # when PINAX_NOTIFICATIONS_BACKENDS is instantiated
+        options = settings.PINAX_NOTIFICATIONS_WEBHOOK_OPTIONS
+        if not options.get("url"):
+            raise ImproperlyConfigured("PINAX_NOTIFICATIONS_WEBHOOK_OPTIONS must define a url")
+        return options
+
+    @cached_property
+    def batch_size(self):
+        return self.options.get("batch_size", 100)
+
+    @cached_property
+    def flush_interval(self):
+        return self.options.get("flush_interval")
+
+    @cached_property
+    def retries(self):
+        return self.options.get("retries", 3)
+
+    @cached_property
+    def backoff(self):
+        return self.options.get("backoff", 0.5)
+
+    @cached_property
+    def formats(self):
+        return self.options.get("formats", ["short.txt", "full.html"])
+
+    @cached_property
+    def headers(self):
+        headers = {"Content-Type": "application/json"}
+        headers.update(self.options.get("headers", {}))
+        return headers
+
+    @cached_property
+    def pool(self):
+        return ConnectionPool(
+            self.options["url"], self.options.get("pool_size", 4), self.options.get("timeout", 5))
+
+    def get_context(self, recipient, sender, notice_type, extra_context):
+        context = super(WebhookBackend, self).get_context()
+        context.update({
+            "recipient": recipient,
+            "sender": sender,
+            "notice": ugettext(notice_type.display),
+        })
+        context.update(extra_context)
+        return context
+
+    def get_notice(self, recipient, sender, notice_type, extra_context):
+        context = self.get_context(recipient, sender, notice_type, extra_context)
+        return {
+            "label": notice_type.label,
+            "recipient": recipient.pk,
+            "email": recipient.email,
+            "sender": getattr(sender, "pk", None),
+            "messages": self.get_formatted_messages(self.formats, notice_type.label, context),
+        }
+
+    def deliver(self, recipient, sender, notice_type, extra_context):
+        self.deliver_many([recipient], sender, notice_type, extra_context)
+
+    def deliver_many(self, recipients, sender, notice_type, extra_context):
+        notices = [
+            self.get_notice(recipient, sender, notice_type, extra_context)
+            for recipient in recipients
+        ]
+        with self.lock:
+            if self.failed:
+                # retried first, so that a persisting error reaches a caller
+                self.post(self.pending)
+                self.pending, self.failed = [], False
+            self.pending.extend(notices)
+            while len(self.pending) >= self.batch_size:
+                batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+                self.post(batch)
+            if not self.pending:
+                return
+            if self.flush_interval is None:
+                self.flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.flush_interval / 1000.0, self.flush_on_timer)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """
+        Sends the notices waiting for their batch to fill up.
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            batch, self.pending = self.pending, []
+            if batch:
+                self.post(batch)
+            self.failed = False
+
+    def flush_on_timer(self):
+        with self.lock:
+            batch = self.pending
+            try:
+                self.flush()
+            except WebhookError as e:
+                # the queue batches of these notices are already deleted:
+                # keep them for the next delivery or the final flush
+                self.pending, self.failed = batch + self.pending, True
+                logging.error("failed to flush webhook notices: {0}".format(e))
+
+    def post(self, notices):
+        body = json.dumps({"notices": notices}).encode("utf-8")
+        tags = {"backend": self.medium_id}
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+                metrics.incr("webhook_retries", **tags)
+            try:
+                with metrics.timer("webhook_post", **tags):
+                    status = self.pool.request(body, self.headers)
+            except (OSError, http_client.HTTPException) as e:
+                error = "{0!r}".format(e)
+                continue
+            if status < 300:
+                metrics.incr("webhook_notices", len(notices), **tags)
+                return
+            error = "HTTP {0}".format(status)
+            if status not in self.retry_statuses and status < 500:
+                break
+        metrics.incr("webhook_failures", **tags)
+        raise WebhookError("posting {0} notices failed: {1}".format(len(notices), error))
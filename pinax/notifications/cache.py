@@ -0,0 +1,190 @@
+"""
+Optional cross-process cache of resolved notice settings.
+
+Each user's settings are cached as a map of
+``(notice type pk, medium, scoping key) -> (setting pk, send)`` in the
+Django cache named by ``PINAX_NOTIFICATIONS_PREFERENCE_CACHE``, with a
+per-process LRU in front of it. Entries are keyed by a per-user version,
+bumped whenever one of the user's settings is saved or deleted, and by a
+global version bumped whenever a notice type changes, so stale entries are
+never read and simply expire.
+"""
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .conf import settings
+
+
+class LRUCache(object):
+    """
+    A small thread-safe least-recently-used mapping.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class PreferenceCache(object):
+
+    prefix = "pinax_notifications:prefs"
+
+    def __init__(self, cache, timeout, lru_size):
+        self.cache = cache
+        self.timeout = timeout
+        self.lru = LRUCache(lru_size)
+
+    def version_key(self, user_pk=None):
+        if user_pk is None:
+            return "{0}:version".format(self.prefix)
+        return "{0}:version:{1}".format(self.prefix, user_pk)
+
+    def new_version(self):
+        # never reuse a version after the version key has been evicted
+        return int(time.time() * 1000000)
+
+    def versions(self, user_pks):
+        """
+        Returns the current ``(user version, global version)`` of each user,
+        initializing missing versions.
+
+        A version the cache did not keep (a dummy cache, or an eviction right
+        after ``add``) falls back to the fresh version generated here, which
+        only misses the cached settings.
+        """
+        keys = [self.version_key(pk) for pk in user_pks] + [self.version_key()]
+        found = self.cache.get_many(keys)
+        missing = dict((key, self.new_version()) for key in keys if key not in found)
+        if missing:
+            for key, version in missing.items():
+                self.cache.add(key, version, None)
+            found.update(self.cache.get_many(list(missing)))
+
+        def version(key):
+            return found.get(key, missing.get(key))
+
+        global_version = version(self.version_key())
+        return dict(
+            (pk, (version(self.version_key(pk)), global_version))
+            for pk in user_pks
+        )
+
+    def map_key(self, user_pk, version):
+        return "{0}:{1}:{2}:{3}".format(self.prefix, user_pk, version[0], version[1])
+
+    def get_many(self, user_pks):
+        """
+        Returns the versions of ``user_pks`` and the cached settings map of
+        each user that has one.
+        """
+        versions = self.versions(user_pks)
+        maps, misses = {}, {}
+        for pk in user_pks:
+            key = self.map_key(pk, versions[pk])
+            value = self.lru.get(key)
+            if value is None:
+                misses[key] = pk
+            else:
+                maps[pk] = value
+        if misses:
+            for key, value in self.cache.get_many(list(misses)).items():
+                self.lru.set(key, value)
+                maps[misses[key]] = value
+        return versions, maps
+
+    def set_many(self, versions, maps):
+        """
+        Stores the settings maps under the versions read before the maps
+        were resolved, so a concurrent change can only orphan them.
+        """
+        values = dict((self.map_key(pk, versions[pk]), value) for pk, value in maps.items())
+        for key, value in values.items():
+            self.lru.set(key, value)
+        self.cache.set_many(values, self.timeout)
+
+    def invalidate(self, user_pk=None):
+        """
+        Invalidates the settings of one user, or of everybody when
+        ``user_pk`` is None.
+        """
+        key = self.version_key(user_pk)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, self.new_version(), None)
+
+
+_preference_cache = None
+
+
+def get_preference_cache():
+    """
+    Returns the preference cache, or None when it is disabled.
+    """
+    global _preference_cache
+    alias = settings.PINAX_NOTIFICATIONS_PREFERENCE_CACHE
+    if alias is None:
+        return None
+    if _preference_cache is None:
+        _preference_cache = PreferenceCache(
+            caches[alias],
+            settings.PINAX_NOTIFICATIONS_PREFERENCE_CACHE_TIMEOUT,
+            settings.PINAX_NOTIFICATIONS_PREFERENCE_CACHE_LRU_SIZE
+        )
+    return _preference_cache
+
+
+@receiver(setting_changed)
+def reset_preference_cache(setting, **kwargs):
+    global _preference_cache
+    if setting.startswith("PINAX_NOTIFICATIONS_PREFERENCE_CACHE"):
+        _preference_cache = None
+
+
+def invalidate_preferences(user_pk=None):
+    preference_cache = get_preference_cache()
+    if preference_cache is not None:
+        preference_cache.invalidate(user_pk)
+
+
+@receiver(post_save, sender="pinax_notifications.NoticeSetting")
+@receiver(post_delete, sender="pinax_notifications.NoticeSetting")
+def notice_setting_changed(sender, instance, **kwargs):
+    invalidate_preferences(instance.user_id)
+
+
+@receiver(post_save, sender="pinax_notifications.NoticeType")
+@receiver(post_delete, sender="pinax_notifications.NoticeType")
+def notice_type_changed(sender, instance, **kwargs):
+    invalidate_preferences()
@@ -46,9 +46,30 @@ def is_installed(package):
 class PinaxNotificationsAppConf(AppConf):
 
     LOCK_WAIT_TIMEOUT = -1
+    LOCK_BACKEND = "pinax.notifications.locks.FileSystemLock"
+    LOCK_LEASE = 60
+    LOCK_CACHE = "default"
     GET_LANGUAGE_MODEL = None
     LANGUAGE_MODEL = None
     QUEUE_ALL = False
+    QUEUE_BATCH_SIZE = 1000
+    EMIT_CHUNK_SIZE = 100
+    QUEUE_COMPRESSION = "zlib"
+    QUEUE_COMPRESSION_THRESHOLD = 1024
+    QUEUE_OUTBOX = False
+    PREFERENCE_CACHE = None
+    PREFERENCE_CACHE_TIMEOUT = 24 * 60 * 60
+    PREFERENCE_CACHE_LRU_SIZE = 10000
+    LOOP_MIN_INTERVAL = 0.5
+    LOOP_MAX_INTERVAL = 30
+    METRICS_SINK = None
+    METRICS_SINK_OPTIONS = {}
+    SINK_OPTIONS = {}
+    WEBHOOK_OPTIONS = {}
+    EMAIL_TEXT_TEMPLATES = False
+    EMAIL_PLAINTEXT_CACHE_SIZE = 1000
+    EMAIL_DETECT_RECIPIENT_INVARIANT = False
+    SUBSCRIPTION_INDEX = False
     BACKENDS = [
         ("email", "pinax.notifications.backends.email.EmailBackend"),
     ]
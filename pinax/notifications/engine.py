@@ -1,18 +1,28 @@
 import sys
 import time
+import select
+import signal
+import threading
 import logging
 import traceback
-import base64
+
+from functools import partial
+from itertools import groupby
 
 from django.core.mail import mail_admins
-from django.utils.six.moves import cPickle as pickle  # pylint: disable-msg=F
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
 
 from django.contrib.auth import get_user_model
 from django.contrib.sites.models import Site
 
-from .lockfile import FileLock, AlreadyLocked, LockTimeout
-from .models import NoticeQueueBatch
+from . import metrics
+from .audiences import Audience
+from .lockfile import AlreadyLocked, LockTimeout
+from .locks import get_lock
+from .models import NoticeQueueBatch, QUEUE_CHANNEL
+from .payload import decode_batch
 from .signals import emitted_notices
+from .utils import chunked
 from . import models as notification
 
 from .conf import settings
@@ -20,75 +30,410 @@ from .conf import settings
 
 def acquire_lock(*args):
     if len(args) == 1:
-        lock = FileLock(args[0])
+        lock = get_lock(args[0])
     else:
-        lock = FileLock("send_notices")
+        lock = get_lock("send_notices")
 
     logging.debug("acquiring lock...")
     try:
         lock.acquire(settings.PINAX_NOTIFICATIONS_LOCK_WAIT_TIMEOUT)
     except AlreadyLocked:
         logging.debug("lock already in place. quitting.")
+        metrics.incr("lock_failures", reason="already_locked", backend=lock.__class__.__name__)
         return
     except LockTimeout:
         logging.debug("waiting for the lock timed out. quitting.")
+        metrics.incr("lock_failures", reason="timeout", backend=lock.__class__.__name__)
         return
     logging.debug("acquired.")
     return lock
 
 
-def send_all(*args):
-    lock = acquire_lock(*args)
+def lock_lost(lock):
+    """
+    Returns whether ``lock`` is known to have been lost while held, in which
+    case another run may already be emitting the same batches.
+    """
+    lost = getattr(lock, "lost", None)
+    return lost is not None and lost.is_set()
+
+
+def emit_notice(user, label, extra_context, sender):
+    logging.info("emitting notice {0} to {1}".format(label, user))
+    return notification.send_now([user], label, extra_context, sender)
+
+
+def emit_notices_to(users, label, extra_context, sender, scoping=None, media=None):
+    """
+    Emits a notice to a chunk of users and returns the number notified.
+    """
+    logging.info("emitting notice {0} to {1} users".format(label, len(users)))
+    return notification._send_now(users, label, extra_context, sender, scoping, media)
+
+
+def emit_to_pks(pks, label, extra_context, sender):
+    """
+    Emits a notice to the users with the given pks, loaded in chunks, and
+    returns the number notified.
+    """
+    sent_actual = 0
+    for chunk in chunked(pks, settings.PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE):
+        users = get_user_model().objects.in_bulk(chunk)
+        for pk in chunk:
+            if pk not in users:
+                # Ignore deleted users, just warn about them
+                logging.warning(
+                    "not emitting notice {0} to user {1} since it does not exist".format(
+                        label,
+                        pk)
+                )
+        recipients = [users[pk] for pk in chunk if pk in users]
+        if recipients:
+            sent_actual += emit_notices_to(recipients, label, extra_context, sender)
+    return sent_actual
+
+
+def emit_batch(notices):
+    """
+    Emits the notices of a single queued batch and returns the number of
+    notices processed and the number actually sent.
+
+    Consecutive notices sharing their label, context and sender are emitted
+    together, in chunks of ``PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE`` users.
+    """
+    sent, sent_actual = 0, 0
+    for _, group in groupby(notices, key=lambda notice: (notice[1], id(notice[2]), id(notice[3]))):
+        group = list(group)
+        _, label, extra_context, sender = group[0]
+        pks = []
+        for user, _, _, _ in group:
+            if isinstance(user, Audience):
+                for chunk in user.chunks():
+                    sent_actual += emit_notices_to(
+                        chunk, label, extra_context, sender, user.scoping, user.media)
+                    sent += len(chunk)
+            else:
+                pks.append(user)
+        if pks:
+            sent_actual += emit_to_pks(pks, label, extra_context, sender)
+            sent += len(pks)
+    return sent, sent_actual
+
+
+def queued_batches(chunk_size=None):
+    """
+    Yields queued batches in creation order, one at a time.
+
+    Only ids are fetched in chunks (by keyset on the primary key) and each
+    payload is loaded on its own, so memory stays bounded however large the
+    backlog is. Batches queued while emitting are picked up as well.
+    """
+    if chunk_size is None:
+        chunk_size = settings.PINAX_NOTIFICATIONS_EMIT_CHUNK_SIZE
+    last_pk = 0
+    while True:
+        pks = list(
+            NoticeQueueBatch.objects.filter(pk__gt=last_pk)
+            .order_by("pk")
+            .values_list("pk", flat=True)[:chunk_size]
+        )
+        if not pks:
+            return
+        for pk in pks:
+            # another worker may have emitted it in the meantime
+            queued_batch = NoticeQueueBatch.objects.filter(pk=pk).first()
+            if queued_batch is not None:
+                yield queued_batch
+        last_pk = pks[-1]
+
+
+def emit_queued(stop=None, max_batches=None, max_notices=None):
+    """
+    Emits queued batches until the queue is empty, ``stop()`` returns True,
+    ``max_batches`` batches have been emitted or at least ``max_notices``
+    notices processed. Budgets are checked between batches, so a batch is
+    never left half emitted. Returns the number of batches, notices
+    processed and notices actually sent.
+    """
+    batches, sent, sent_actual = 0, 0, 0
+    for queued_batch in queued_batches():
+        if stop is not None and stop():
+            break
+        if max_batches is not None and batches >= max_batches:
+            break
+        if max_notices is not None and sent >= max_notices:
+            break
+        with metrics.timer("emit_batch"):
+            notices = decode_batch(queued_batch.pickled_data)
+            batch_sent, batch_sent_actual = emit_batch(notices)
+            sent += batch_sent
+            sent_actual += batch_sent_actual
+            queued_batch.delete()
+        batches += 1
+        metrics.incr("batches")
+    return batches, sent, sent_actual
+
+
+def report_exception():
+    # get the exception
+    _, e, _ = sys.exc_info()
+    # email people
+    current_site = Site.objects.get_current()
+    subject = "[{0} emit_notices] {1}".format(current_site.name, e)
+    message = "\n".join(
+        traceback.format_exception(*sys.exc_info())  # pylint: disable-msg=W0142
+    )
+    mail_admins(subject, message, fail_silently=True)
+    # log it as critical
+    logging.critical("an exception occurred: {0}".format(e))
+
+
+def emit_and_report(stop=None, max_batches=None, max_notices=None):
+    """
+    A single drain of the queue, reporting via ``emitted_notices`` and
+    mailing the admins if anything goes wrong. Returns the number of
+    batches emitted and notices processed.
+    """
     batches, sent, sent_actual = 0, 0, 0
     start_time = time.time()
+    try:
+        batches, sent, sent_actual = emit_queued(
+            stop=stop, max_batches=max_batches, max_notices=max_notices)
+        emitted_notices.send(
+            sender=NoticeQueueBatch,
+            batches=batches,
+            sent=sent,
+            sent_actual=sent_actual,
+            run_time="%.2f seconds" % (time.time() - start_time)
+        )
+    except Exception:  # pylint: disable-msg=W0703
+        metrics.incr("emit_errors")
+        report_exception()
+    metrics.flush()
+
+    logging.info("")
+    logging.info("{0} batches, {1} sent".format(batches, sent,))
+    logging.info("done in {0:.2f} seconds".format(time.time() - start_time))
+    return batches, sent
+
+
+def with_deadline(stop, max_seconds):
+    """
+    Returns a ``stop`` function that also becomes True once ``max_seconds``
+    seconds have passed.
+    """
+    if max_seconds is None:
+        return stop
+    deadline = time.time() + max_seconds
+
+    def check():
+        return time.time() >= deadline or (stop is not None and stop())
+    return check
+
+
+def remaining_budget(budget, spent):
+    """
+    Returns what is left of ``budget`` (None when unlimited), never negative.
+    """
+    if budget is None:
+        return None
+    return max(budget - spent, 0)
+
+
+def report_backlog():
+    """
+    Logs and returns the number of batches left in the queue.
+    """
+    remaining = NoticeQueueBatch.objects.count()
+    logging.info("{0} batches remaining".format(remaining))
+    return remaining
+
+
+def send_all(*args, **options):
+    """
+    Drains the queue. ``max_seconds`` and ``max_notices`` bound the run,
+    which then stops at the next batch boundary and reports the backlog.
+    The run also stops at the next batch if the lock is lost.
+    """
+    max_seconds = options.get("max_seconds")
+    max_notices = options.get("max_notices")
+
+    lock = acquire_lock(*args)
+    if lock is None:
+        return
 
     try:
-        # nesting the try statement to be Python 2.4
+        emit_and_report(
+            stop=with_deadline(partial(lock_lost, lock), max_seconds), max_notices=max_notices)
+        if max_seconds is not None or max_notices is not None:
+            report_backlog()
+    finally:
+        logging.debug("releasing lock...")
+        lock.release()
+        logging.debug("released.")
+
+
+def next_interval(interval, busy, min_interval, max_interval):
+    """
+    Adaptive polling: poll again right away while the queue is busy and back
+    off exponentially while it is idle.
+    """
+    if busy:
+        return min_interval
+    return min(max(interval, min_interval) * 2, max_interval)
+
+
+class QueueWaiter(object):
+    """
+    Waits for new batches to be queued.
+
+    On PostgreSQL this LISTENs for the NOTIFY sent by ``queue`` and wakes up
+    as soon as a batch is committed; elsewhere, or while the database is
+    unreachable, it simply sleeps.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+        self.listening = self.connection.vendor == "postgresql"
+        # the DB-API connection the LISTEN was issued on
+        self.listened_on = None
+        self.listen()
+
+    def listen(self):
+        """
+        Issues LISTEN again when the connection was reopened since.
+        """
+        if not self.listening:
+            return
         try:
-            for queued_batch in NoticeQueueBatch.objects.all():
-                notices = pickle.loads(base64.b64decode(queued_batch.pickled_data))
-                for user, label, extra_context, sender in notices:
+            self.connection.ensure_connection()
+            if self.listened_on is not self.connection.connection:
+                with self.connection.cursor() as cursor:
+                    cursor.execute("LISTEN {0}".format(QUEUE_CHANNEL))
+                self.listened_on = self.connection.connection
+        except DatabaseError:
+            logging.warning("could not LISTEN for queued batches, polling instead")
+            self.listened_on = None
+
+    def wait(self, timeout, stop):
+        """
+        Returns True when woken by a notification, False when ``timeout``
+        seconds passed or ``stop()`` became True.
+        """
+        deadline = time.time() + timeout
+        while not stop():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if self.listened_on is not None and self.listened_on is self.connection.connection:
+                conn = self.listened_on
+                try:
+                    if select.select([conn], [], [], min(remaining, 1)) != ([], [], []):
+                        conn.poll()
+                        if conn.notifies:
+                            del conn.notifies[:]
+                            return True
+                except Exception:  # pylint: disable-msg=W0703
+                    # the connection broke; sleep until the loop reconnects
+                    logging.warning("lost the LISTEN connection, polling instead")
+                    self.listened_on = None
                     try:
-                        user = get_user_model().objects.get(pk=user)
-                        logging.info("emitting notice {0} to {1}".format(label, user))
-                        # call this once per user to be atomic and allow for logging to
-                        # accurately show how long each takes.
-                        if notification.send_now([user], label, extra_context, sender):
-                            sent_actual += 1
-                    except get_user_model().DoesNotExist:
-                        # Ignore deleted users, just warn about them
-                        logging.warning(
-                            "not emitting notice {0} to user {1} since it does not exist".format(
-                                label,
-                                user)
-                        )
-                    sent += 1
-                queued_batch.delete()
-                batches += 1
-            emitted_notices.send(
-                sender=NoticeQueueBatch,
-                batches=batches,
-                sent=sent,
-                sent_actual=sent_actual,
-                run_time="%.2f seconds" % (time.time() - start_time)
-            )
-        except Exception:  # pylint: disable-msg=W0703
-            # get the exception
-            _, e, _ = sys.exc_info()
-            # email people
-            current_site = Site.objects.get_current()
-            subject = "[{0} emit_notices] {1}".format(current_site.name, e)
-            message = "\n".join(
-                traceback.format_exception(*sys.exc_info())  # pylint: disable-msg=W0142
+                        self.connection.close()
+                    except DatabaseError:
+                        pass
+            else:
+                time.sleep(min(remaining, 1))
+        return False
+
+    def close(self):
+        if self.listened_on is not None and self.listened_on is self.connection.connection:
+            try:
+                with self.connection.cursor() as cursor:
+                    cursor.execute("UNLISTEN {0}".format(QUEUE_CHANNEL))
+            except DatabaseError:
+                pass
+
+
+def recycle_connections():
+    """
+    Closes the connections that errored or outlived ``CONN_MAX_AGE``, as
+    Django does between requests, so a long-running loop reconnects after a
+    database restart or failover. Connections inside a transaction are left
+    alone.
+    """
+    for connection in connections.all():
+        if not connection.in_atomic_block:
+            connection.close_if_unusable_or_obsolete()
+
+
+def install_signal_handlers(handler):
+    """
+    Handles SIGTERM and SIGINT with ``handler`` when running in the main
+    thread. Returns the previous handlers.
+    """
+    previous_handlers = {}
+    if threading.current_thread().name == "MainThread":
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            previous_handlers[signum] = signal.signal(signum, handler)
+    return previous_handlers
+
+
+def send_loop(*args, **options):
+    """
+    Keeps emitting queued notices until SIGTERM/SIGINT is received, the lock
+    is lost or ``max_batches`` batches, ``max_notices`` notices or
+    ``max_seconds`` seconds have been spent, after which the process is
+    expected to be restarted by its supervisor.
+    """
+    min_interval = options.get("min_interval") or settings.PINAX_NOTIFICATIONS_LOOP_MIN_INTERVAL
+    max_interval = options.get("max_interval") or settings.PINAX_NOTIFICATIONS_LOOP_MAX_INTERVAL
+    max_batches = options.get("max_batches")
+    max_notices = options.get("max_notices")
+    max_seconds = options.get("max_seconds")
+
+    lock = acquire_lock(*args)
+    if lock is None:
+        return
+
+    stopping = []
+
+    def stopped():
+        return bool(stopping) or lock_lost(lock)
+    stop = with_deadline(stopped, max_seconds)
+
+    def handle_signal(signum, frame):
+        logging.info("received signal {0}, stopping after the current batch".format(signum))
+        stopping.append(signum)
+
+    previous_handlers = install_signal_handlers(handle_signal)
+    waiter = QueueWaiter()
+    interval, total, total_sent = min_interval, 0, 0
+    try:
+        while not stop():
+            recycle_connections()
+            waiter.listen()
+            batches, sent = emit_and_report(
+                stop=stop,
+                max_batches=remaining_budget(max_batches, total),
+                max_notices=remaining_budget(max_notices, total_sent)
             )
-            mail_admins(subject, message, fail_silently=True)
-            # log it as critical
-            logging.critical("an exception occurred: {0}".format(e))
+            total += batches
+            total_sent += sent
+            if remaining_budget(max_batches, total) == 0 or remaining_budget(max_notices, total_sent) == 0:
+                break
+            interval = next_interval(interval, batches > 0, min_interval, max_interval)
+            if not batches and waiter.wait(interval, stop):
+                interval = min_interval
+        if lock_lost(lock):
+            logging.info("lost the lock, stopping")
+        elif not stopped():
+            # a budget ran out rather than a signal
+            logging.info("emitted {0} batches, recycling".format(total))
+            report_backlog()
     finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+        waiter.close()
         logging.debug("releasing lock...")
         lock.release()
         logging.debug("released.")
-
-    logging.info("")
-    logging.info("{0} batches, {1} sent".format(batches, sent,))
-    logging.info("done in {0:.2f} seconds".format(time.time() - start_time))
@@ -3,6 +3,8 @@ lockfile.py - Platform-independent advisory file locks.
 
 Requires Python 2.5 unless you apply 2.4.diff
 Locking is done on a per-thread basis instead of a per-process basis.
+On Linux FileLock is FcntlFileLock, which uses flock(2) and locks per lock
+object instead.
 
 Usage:
 
@@ -58,6 +60,12 @@ import errno
 
 from .compat import quote, get_ident
 
+try:
+    import fcntl
+    import signal
+except ImportError:
+    fcntl = None
+
 # Work with PEP8 and non-PEP8 versions of threading module.
 if not hasattr(threading, "current_thread"):
     threading.current_thread = threading.currentThread
@@ -67,7 +75,7 @@ if not hasattr(threading.Thread, "get_name"):
 
 __all__ = ["Error", "LockError", "LockTimeout", "AlreadyLocked",
            "LockFailed", "UnlockError", "NotLocked", "NotMyLock",
-           "LinkFileLock", "MkdirFileLock", "SQLiteFileLock"]
+           "LinkFileLock", "MkdirFileLock", "SQLiteFileLock", "FcntlFileLock"]
 
 
 class Error(Exception):
@@ -515,8 +523,123 @@ class SQLiteFileLock(LockBase):
         self.connection.commit()
 
 
+class FcntlFileLock(LockBase):
+    """Lock a file using flock(2) kernel advisory locks.
+
+    Waiting blocks in the kernel instead of polling, and the lock is
+    released by the kernel when the holding process dies, so a lock file
+    left behind by a crashed process is never stale.
+    """
+
+    def __init__(self, path, threaded=True):
+        LockBase.__init__(self, path, threaded)
+        self.fd = None
+
+    def _try_lock(self, fd, flags):
+        try:
+            fcntl.flock(fd, flags)
+        except (IOError, OSError):
+            err = sys.exc_info()[1]
+            if err.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                return False
+            raise LockFailed("failed to lock %s" % self.lock_file)
+        return True
+
+    def _lock_with_timeout(self, fd, timeout):
+        if threading.current_thread().name != "MainThread":
+            # signals can only interrupt the main thread, poll instead
+            end_time = time.time() + timeout
+            wait = 0.001
+            while not self._try_lock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                if time.time() > end_time:
+                    return False
+                time.sleep(wait)
+                wait = min(wait * 2, 0.05)
+            return True
+
+        class Expired(Exception):
+            pass
+
+        def expire(signum, frame):
+            raise Expired
+
+        previous = signal.signal(signal.SIGALRM, expire)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            return self._try_lock(fd, fcntl.LOCK_EX)
+        except Expired:
+            return False
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+    def acquire(self, timeout=None):
+        if self.fd is not None:
+            # Already locked by me.
+            return
+        try:
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            raise LockFailed("failed to create %s" % self.lock_file)
+        try:
+            if timeout is None:
+                locked = self._try_lock(fd, fcntl.LOCK_EX)
+            elif timeout <= 0:
+                locked = self._try_lock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                locked = self._lock_with_timeout(fd, timeout)
+        except BaseException:
+            os.close(fd)
+            raise
+        if not locked:
+            os.close(fd)
+            if timeout is not None and timeout > 0:
+                raise LockTimeout
+            raise AlreadyLocked
+        # Record the holder to ease debugging.
+        os.ftruncate(fd, 0)
+        os.write(fd, self.unique_name.encode("utf-8"))
+        self.fd = fd
+
+    def release(self):
+        if self.fd is None:
+            if self.is_locked():
+                raise NotMyLock
+            raise NotLocked
+        # The file is left in place: unlinking it would let another process
+        # lock a new inode while a third still waits on the old one.
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def is_locked(self):
+        if self.fd is not None:
+            return True
+        if not os.path.exists(self.lock_file):
+            return False
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if self._try_lock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                return False
+            return True
+        finally:
+            os.close(fd)
+
+    def i_am_locking(self):
+        return self.fd is not None
+
+    def break_lock(self):
+        # The kernel releases the lock of dead processes; all that can be
+        # done for a live holder is to remove the file.
+        if os.path.exists(self.lock_file):
+            os.unlink(self.lock_file)
+
+
 # pylint: disable-msg=C0103
-if hasattr(os, "link"):
+if fcntl is not None and sys.platform.startswith("linux"):
+    FileLock = FcntlFileLock
+elif hasattr(os, "link"):
     FileLock = LinkFileLock
 else:
     FileLock = MkdirFileLock
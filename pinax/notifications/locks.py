@@ -0,0 +1,223 @@
+"""
+Locks preventing concurrent ``emit_notices`` runs.
+
+The backend is chosen with ``PINAX_NOTIFICATIONS_LOCK_BACKEND``. The
+default ``FileSystemLock`` only protects a single host; ``DatabaseLock``
+and ``CacheLock`` hold a lease shared by every host using the same
+database or cache, renewed by a heartbeat thread while held and expiring
+on its own if the holder dies.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from datetime import timedelta
+
+from django.core.cache import caches
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from . import metrics
+from .conf import settings, load_path_attr
+from .lockfile import FileLock, AlreadyLocked, LockTimeout
+
+
+def get_lock(name):
+    """
+    Returns an instance of the configured lock backend for ``name``.
+    """
+    backend = settings.PINAX_NOTIFICATIONS_LOCK_BACKEND
+    if isinstance(backend, str):
+        backend = load_path_attr(backend)
+    return backend(name)
+
+
+class BaseLock(object):
+    """
+    The base lock backend.
+
+    ``acquire`` follows the ``lockfile`` conventions: a timeout of None
+    waits forever, a positive timeout waits that many seconds before raising
+    LockTimeout, and zero or less raises AlreadyLocked right away.
+
+    ``lost`` is set when the lock is known to have been lost while held, in
+    which case ``emit_notices`` stops at the next batch.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lost = threading.Event()
+
+    def acquire(self, timeout=None):
+        raise NotImplementedError()
+
+    def release(self):
+        raise NotImplementedError()
+
+
+class FileSystemLock(BaseLock):
+    """
+    A lock file on the local filesystem.
+    """
+
+    def __init__(self, name):
+        super(FileSystemLock, self).__init__(name)
+        self.lock = FileLock(name)
+
+    def acquire(self, timeout=None):
+        self.lock.acquire(timeout)
+
+    def release(self):
+        self.lock.release()
+
+
+class LeaseLock(BaseLock):
+    """
+    A lock held as an expiring lease which a heartbeat thread renews every
+    third of ``PINAX_NOTIFICATIONS_LOCK_LEASE`` seconds.
+    """
+
+    poll_interval = 0.5
+
+    def __init__(self, name):
+        super(LeaseLock, self).__init__(name)
+        self.lease = settings.PINAX_NOTIFICATIONS_LOCK_LEASE
+        self.owner = "{0}:{1}:{2}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self.heartbeat = None
+        self.stopped = threading.Event()
+
+    def try_acquire(self):
+        raise NotImplementedError()
+
+    def renew(self):
+        """
+        Extends the lease, returning False if it was lost.
+        """
+        raise NotImplementedError()
+
+    def delete(self):
+        raise NotImplementedError()
+
+    def acquire(self, timeout=None):
+        end_time = time.time()
+        if timeout is not None and timeout > 0:
+            end_time += timeout
+        while not self.try_acquire():
+            if timeout is not None and time.time() >= end_time:
+                if timeout > 0:
+                    raise LockTimeout
+                raise AlreadyLocked
+            time.sleep(self.poll_interval)
+        self.lost.clear()
+        self.start_heartbeat()
+
+    def release(self):
+        self.stopped.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+            self.heartbeat = None
+        self.delete()
+
+    def start_heartbeat(self):
+        self.stopped.clear()
+        self.heartbeat = threading.Thread(target=self.beat, name="lock-heartbeat")
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+
+    def beat(self):
+        try:
+            while not self.stopped.wait(self.lease / 3.0):
+                try:
+                    renewed = self.renew()
+                except Exception:  # pylint: disable-msg=W0703
+                    logging.exception("renewing the {0} lock lease failed".format(self.name))
+                    renewed = False
+                if not renewed:
+                    # the lease expires without a heartbeat anyway
+                    logging.warning("lost the {0} lock lease".format(self.name))
+                    metrics.incr("lock_lost", backend=self.__class__.__name__)
+                    self.lost.set()
+                    return
+        finally:
+            self.close_connection()
+
+    def close_connection(self):
+        pass
+
+
+class DatabaseLock(LeaseLock):
+    """
+    A lease stored as a ``NoticeLock`` row.
+    """
+
+    def expires_at(self):
+        return timezone.now() + timedelta(seconds=self.lease)
+
+    def try_acquire(self):
+        from .models import NoticeLock
+
+        # take over a lease whose holder stopped renewing it
+        if NoticeLock.objects.filter(name=self.name, expires_at__lt=timezone.now()).update(
+                owner=self.owner, expires_at=self.expires_at()):
+            return True
+        try:
+            with transaction.atomic():
+                NoticeLock.objects.create(
+                    name=self.name, owner=self.owner, expires_at=self.expires_at())
+        except IntegrityError:
+            return False
+        return True
+
+    def renew(self):
+        from .models import NoticeLock
+
+        return bool(NoticeLock.objects.filter(name=self.name, owner=self.owner).update(
+            expires_at=self.expires_at()))
+
+    def delete(self):
+        from .models import NoticeLock
+
+        NoticeLock.objects.filter(name=self.name, owner=self.owner).delete()
+
+    def close_connection(self):
+        # the heartbeat thread has its own connection
+        connection.close()
+
+
+class CacheLock(LeaseLock):
+    """
+    A lease stored in the Django cache named by
+    ``PINAX_NOTIFICATIONS_LOCK_CACHE``, which must be shared by every host
+    (e.g. memcached or redis).
+
+    Renewals extend the lease with ``cache.touch``. Before Django 2.1 they
+    set it again instead, so exclusion is only best effort: a lease expiring
+    while it is being renewed may end up held by two hosts.
+    """
+
+    def __init__(self, name):
+        super(CacheLock, self).__init__(name)
+        self.cache = caches[settings.PINAX_NOTIFICATIONS_LOCK_CACHE]
+        self.key = "pinax_notifications:lock:{0}".format(name)
+
+    def try_acquire(self):
+        return self.cache.add(self.key, self.owner, self.lease)
+
+    def renew(self):
+        if self.cache.get(self.key) != self.owner:
+            return False
+        if not hasattr(self.cache, "touch"):
+            # before Django 2.1 the lease can only be set again, which
+            # overwrites it if it expired and was taken over since the check
+            self.cache.set(self.key, self.owner, self.lease)
+            return True
+        # touch never changes the owner, so a lease taken over since the
+        # check is left alone and seen by checking again
+        return self.cache.touch(self.key, self.lease) and self.cache.get(self.key) == self.owner
+
+    def delete(self):
+        if self.cache.get(self.key) == self.owner:
+            self.cache.delete(self.key)
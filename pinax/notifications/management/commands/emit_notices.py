@@ -2,13 +2,63 @@ import logging
 
 from django.core.management.base import BaseCommand
 
-from pinax.notifications.engine import send_all
+from pinax.notifications.engine import send_all, send_loop
+from pinax.notifications.profiling import profile
 
 
 class Command(BaseCommand):
     help = "Emit queued notices."
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loop", action="store_true", default=False,
+            help="Keep running and poll the queue with adaptive backoff until SIGTERM.")
+        parser.add_argument(
+            "--min-interval", type=float, default=None,
+            help="Polling interval in seconds while the queue is busy (with --loop).")
+        parser.add_argument(
+            "--max-interval", type=float, default=None,
+            help="Longest polling interval in seconds while the queue is idle (with --loop).")
+        parser.add_argument(
+            "--max-batches", type=int, default=None,
+            help="Exit after emitting this many batches so a supervisor can restart "
+                 "the process (with --loop).")
+        parser.add_argument(
+            "--max-seconds", type=float, default=None,
+            help="Stop at the next batch boundary once this many seconds have passed "
+                 "and report the remaining backlog.")
+        parser.add_argument(
+            "--max-notices", type=int, default=None,
+            help="Stop at the next batch boundary once this many notices have been "
+                 "processed and report the remaining backlog.")
+        parser.add_argument(
+            "--profile", nargs="?", const="emit_notices.prof", default=None, metavar="PATH",
+            help="Run under a profiler and write the stats, sorted by cumulative time, and "
+                 "an aggregated SQL log to PATH (default: emit_notices.prof).")
+
     def handle(self, *args, **options):
         logging.basicConfig(level=logging.DEBUG, format="%(message)s")
         logging.info("-" * 72)
-        send_all(*args)
+        if options["loop"]:
+            def run():
+                send_loop(
+                    *args,
+                    min_interval=options["min_interval"],
+                    max_interval=options["max_interval"],
+                    max_batches=options["max_batches"],
+                    max_seconds=options["max_seconds"],
+                    max_notices=options["max_notices"]
+                )
+        else:
+            def run():
+                send_all(
+                    *args,
+                    max_seconds=options["max_seconds"],
+                    max_notices=options["max_notices"]
+                )
+
+        if options["profile"]:
+            self.stdout.write(profile(run, options["profile"]))
+            self.stdout.write("SQL log written to {0}.sql.txt".format(options["profile"]))
+        else:
+            run()
@@ -0,0 +1,36 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from pinax.notifications.stats import queue_stats
+
+
+def format_age(seconds):
+    return "-" if seconds is None else "{0:.0f}s".format(seconds)
+
+
+class Command(BaseCommand):
+    help = "Report the depth and age of the notice queue."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--json", action="store_true", default=False,
+            help="Write the statistics as JSON.")
+
+    def handle(self, *args, **options):
+        stats = queue_stats()
+        if options["json"]:
+            self.stdout.write(json.dumps(stats, sort_keys=True))
+            return
+        self.stdout.write("{0} batches, {1} recipients and {2} audiences queued".format(
+            stats["depth"], stats["recipients"], stats["audiences"]))
+        self.stdout.write("oldest batch: {0}".format(format_age(stats["oldest_age"])))
+        for group, rows in (("label", stats["labels"]), ("priority", stats["priorities"])):
+            if not rows:
+                continue
+            self.stdout.write("")
+            self.stdout.write("{0:<40} {1:>10} {2:>12} {3:>10}".format(
+                group, "batches", "recipients", "oldest"))
+            for row in rows:
+                self.stdout.write("{0:<40} {1:>10} {2:>12} {3:>10}".format(
+                    row[group], row["batches"], row["recipients"], format_age(row["oldest_age"])))
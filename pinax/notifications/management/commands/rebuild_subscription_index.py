@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from pinax.notifications.subscriptions import index_enabled, rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the subscription index from the notice settings."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size", type=int, default=None,
+            help="How many users to rebuild at a time "
+                 "(default: PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE).")
+
+    def handle(self, *args, **options):
+        if not index_enabled():
+            raise CommandError("PINAX_NOTIFICATIONS_SUBSCRIPTION_INDEX is not enabled.")
+        count = rebuild_index(options["chunk_size"])
+        self.stdout.write("Rebuilt the subscription index of {0} users.".format(count))
@@ -0,0 +1,270 @@
+"""
+Stage-level counters and timings.
+
+Instrumented code calls ``incr`` and ``timer``; the values go to the sink
+configured by ``PINAX_NOTIFICATIONS_METRICS_SINK``. When no sink is
+configured both are no-ops.
+"""
+from __future__ import division
+
+import bisect
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .conf import settings, load_path_attr
+
+
+class BaseSink(object):
+    """
+    The base metrics sink.
+    """
+
+    def incr(self, name, value=1, tags=None):
+        raise NotImplementedError()
+
+    def timing(self, name, seconds, tags=None):
+        raise NotImplementedError()
+
+    def flush(self):
+        """
+        Called at the end of each ``emit_notices`` run.
+        """
+        pass
+
+
+def _key(name, tags):
+    return name, tuple(sorted((tags or {}).items()))
+
+
+class InMemorySink(BaseSink):
+    """
+    Keeps counters and raw timings in memory, mostly useful for tests and
+    benchmarks.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, name, value=1, tags=None):
+        key = _key(name, tags)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def timing(self, name, seconds, tags=None):
+        key = _key(name, tags)
+        with self.lock:
+            self.timings.setdefault(key, []).append(seconds)
+
+    def count(self, name, **tags):
+        """
+        The sum of the ``name`` counters matching ``tags``.
+        """
+        return sum(
+            value for (key, key_tags), value in self.counters.items()
+            if key == name and set(tags.items()) <= set(key_tags)
+        )
+
+    def values(self, name, **tags):
+        """
+        Every recorded ``name`` timing matching ``tags``.
+        """
+        return [
+            value
+            for (key, key_tags), values in self.timings.items()
+            if key == name and set(tags.items()) <= set(key_tags)
+            for value in values
+        ]
+
+
+class StatsdSink(BaseSink):
+    """
+    Sends metrics over UDP to a StatsD daemon, by default on localhost.
+    Tags are sent in the DogStatsD ``|#tag:value`` format when ``tags`` is
+    True and folded into the metric name otherwise.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8125, prefix="pinax_notifications", tags=False):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.tags = tags
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def format(self, name, value, kind, tags):
+        name = "{0}.{1}".format(self.prefix, name) if self.prefix else name
+        if tags and self.tags:
+            return "{0}:{1}|{2}|#{3}".format(
+                name, value, kind, ",".join("{0}:{1}".format(k, v) for k, v in sorted(tags.items()))
+            )
+        if tags:
+            name = ".".join([name] + [str(v) for _, v in sorted(tags.items())])
+        return "{0}:{1}|{2}".format(name, value, kind)
+
+    def send(self, line):
+        try:
+            self.socket.sendto(line.encode("utf-8"), self.address)
+        except (socket.error, OSError):
+            # metrics must never break delivery
+            pass
+
+    def incr(self, name, value=1, tags=None):
+        self.send(self.format(name, value, "c", tags))
+
+    def timing(self, name, seconds, tags=None):
+        self.send(self.format(name, "{0:.3f}".format(seconds * 1000), "ms", tags))
+
+
+class PrometheusTextfileSink(InMemorySink):
+    """
+    Aggregates metrics in memory and writes them in the Prometheus text
+    exposition format to ``path`` on ``flush``, for the node_exporter
+    textfile collector.
+
+    Timings are kept as histograms (a count per bucket, a sum and a count)
+    rather than raw samples, so memory stays constant in long-running loops.
+    """
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+    def __init__(self, path, prefix="pinax_notifications"):
+        super(PrometheusTextfileSink, self).__init__()
+        self.path = path
+        self.prefix = prefix
+
+    def reset(self):
+        super(PrometheusTextfileSink, self).reset()
+        self.histograms = {}
+
+    def timing(self, name, seconds, tags=None):
+        key = _key(name, tags)
+        # the first bucket holding the value, or len(buckets) for +Inf
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def format_labels(self, tags, extra=()):
+        pairs = list(tags) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{0}="{1}"'.format(k, v) for k, v in pairs) + "}"
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, (list(counts), total, count))
+                for key, (counts, total, count) in self.histograms.items()
+            )
+        for (name, tags), value in counters:
+            lines.append("{0}_{1}_total{2} {3}".format(
+                self.prefix, name, self.format_labels(tags), value))
+        for (name, tags), (counts, total, count) in histograms:
+            metric = "{0}_{1}_seconds".format(self.prefix, name)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append("{0}_bucket{1} {2}".format(
+                    metric, self.format_labels(tags, [("le", bound)]), cumulative))
+            lines.append("{0}_bucket{1} {2}".format(
+                metric, self.format_labels(tags, [("le", "+Inf")]), count))
+            lines.append("{0}_sum{1} {2}".format(metric, self.format_labels(tags), total))
+            lines.append("{0}_count{1} {2}".format(metric, self.format_labels(tags), count))
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        # write atomically so the collector never reads a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, "w") as fp:
+            fp.write(self.render())
+        os.rename(tmp_path, self.path)
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer(object):
+
+    def __init__(self, sink, name, tags):
+        self.sink = sink
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.sink.timing(self.name, time.time() - self.start, self.tags)
+
+
+_sink = None
+_sink_loaded = False
+
+
+def get_sink():
+    """
+    Returns the configured sink or None if metrics are disabled.
+    """
+    global _sink, _sink_loaded
+    if not _sink_loaded:
+        value = settings.PINAX_NOTIFICATIONS_METRICS_SINK
+        if isinstance(value, str):
+            value = load_path_attr(value)(**settings.PINAX_NOTIFICATIONS_METRICS_SINK_OPTIONS)
+        _sink, _sink_loaded = value, True
+    return _sink
+
+
+@receiver(setting_changed)
+def reset_sink(setting, **kwargs):
+    global _sink, _sink_loaded
+    if setting.startswith("PINAX_NOTIFICATIONS_METRICS_SINK"):
+        _sink, _sink_loaded = None, False
+
+
+def incr(name, value=1, **tags):
+    sink = get_sink()
+    if sink is not None:
+        sink.incr(name, value, tags)
+
+
+def timer(name, **tags):
+    """
+    A context manager recording how long its block took as a ``name``
+    timing.
+    """
+    sink = get_sink()
+    if sink is None:
+        return NULL_TIMER
+    return Timer(sink, name, tags)
+
+
+def flush():
+    sink = get_sink()
+    if sink is not None:
+        sink.flush()
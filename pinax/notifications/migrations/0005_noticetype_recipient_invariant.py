@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 12:43
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinax_notifications', '0004_noticelock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='noticetype',
+            name='recipient_invariant',
+            field=models.BooleanField(default=False, help_text='The templates of this notice type do not depend on the recipient', verbose_name='recipient invariant'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 12:50
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pinax_notifications', '0005_noticetype_recipient_invariant'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoticeSubscriptionIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('medium', models.CharField(max_length=100)),
+                ('enabled', models.BinaryField(default=b'')),
+                ('configured', models.BinaryField(default=b'')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='noticesubscriptionindex',
+            unique_together=set([('user', 'medium')]),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 12:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def backfill_batch_metadata(apps, schema_editor):
+    """Fill in the label and recipient count of the batches queued before the
+    upgrade, so that they show up correctly in the queue statistics."""
+    from ..payload import describe_batch
+    NoticeQueueBatch = apps.get_model('pinax_notifications', 'NoticeQueueBatch')
+    batches = NoticeQueueBatch.objects.using(schema_editor.connection.alias).only('pickled_data')
+    for batch in batches.iterator():
+        label, recipient_count = describe_batch(batch.pickled_data)
+        batches.filter(pk=batch.pk).update(label=label[:40], recipient_count=recipient_count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinax_notifications', '0007_storednotice'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='created_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='label',
+            field=models.CharField(blank=True, db_index=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='priority',
+            field=models.SmallIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='recipient_count',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.RunPython(backfill_batch_metadata, migrations.RunPython.noop),
+    ]
@@ -1,25 +1,41 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
-import base64
+from collections import Counter, OrderedDict
 
-from django.db import models
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.db.models.query import QuerySet
 from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import get_language, activate
 from django.utils.encoding import python_2_unicode_compatible
-from django.utils.six.moves import cPickle as pickle  # pylint: disable-msg=F
 
 from django.contrib.contenttypes.models import ContentType
 
+from . import metrics, outbox
+from .audiences import Audience
+from .cache import invalidate_preferences
 from .compat import GenericForeignKey
 from .conf import settings
-from .utils import load_media_defaults, notice_setting_for_user
+from .payload import encode_batch
+from .utils import (
+    chunked, load_media_defaults, notice_setting_for_user, prefetch_notice_settings
+)
 
 
 NOTICE_MEDIA, NOTICE_MEDIA_DEFAULTS = load_media_defaults()
 
+# PostgreSQL channel notified whenever batches are queued
+QUEUE_CHANNEL = "pinax_notifications_queue"
+
+# the NoticeType fields set by create and create_many
+NOTICE_TYPE_FIELDS = ["display", "description", "permission", "default", "recipient_invariant"]
+
 
 class LanguageStoreNotAvailable(Exception):
     pass
@@ -39,6 +55,12 @@ class NoticeType(models.Model):
     # by default only on for media with sensitivity less than or equal to this number
     default = models.IntegerField(_("default"))
 
+    # the templates do not use the recipient, so they can be rendered once
+    # and shared by every recipient
+    recipient_invariant = models.BooleanField(
+        _("recipient invariant"), default=False,
+        help_text="The templates of this notice type do not depend on the recipient")
+
     def __str__(self):
         return self.label
 
@@ -47,37 +69,114 @@ class NoticeType(models.Model):
         verbose_name_plural = _("notice types")
 
     @classmethod
-    def create(cls, label, display, description, permission='', default=2, verbosity=1):
+    def create(cls, label, display, description, permission='', default=2, verbosity=1,
+               recipient_invariant=False):
         """
         Creates a new NoticeType.
 
         This is intended to be used by other apps as a post_syncdb manangement step.
         """
+        values = _notice_type_values(
+            label, display, description, permission, default, recipient_invariant)
         try:
             notice_type = cls._default_manager.get(label=label)
-            updated = False
-            if display != notice_type.display:
-                notice_type.display = display
-                updated = True
-            if description != notice_type.description:
-                notice_type.description = description
-                updated = True
-            if default != notice_type.default:
-                notice_type.default = default
-                updated = True
-            if permission != notice_type.permission:
-                notice_type.permission = permission
-                updated = True
-            if updated:
+            if _apply_changes(notice_type, values, NOTICE_TYPE_FIELDS):
                 notice_type.save()
                 if verbosity > 1:
                     print("Updated %s NoticeType" % label)
         except cls.DoesNotExist:
-            cls(label=label, display=display, description=description,
-                permission=permission, default=default).save()
+            cls(**values).save()
             if verbosity > 1:
                 print("Created %s NoticeType" % label)
 
+    @classmethod
+    def create_many(cls, specs, verbosity=1):
+        """
+        Creates or updates many NoticeTypes at once.
+
+        ``specs`` is an iterable of argument tuples or keyword dicts, as taken
+        by ``create``. Existing types are fetched with a single query and the
+        changes applied in bulk within one transaction. Returns a dict with
+        the number of ``created``, ``updated`` and ``unchanged`` types.
+        """
+        wanted = OrderedDict(
+            (values["label"], values) for values in map(_notice_type_spec, specs)
+        )
+
+        created, updated, unchanged = [], [], 0
+        with transaction.atomic():
+            existing = dict(
+                (notice_type.label, notice_type)
+                for notice_type in cls._default_manager.filter(label__in=list(wanted))
+            )
+            for label, values in wanted.items():
+                notice_type = existing.get(label)
+                if notice_type is None:
+                    created.append(cls(**values))
+                elif _apply_changes(notice_type, values, NOTICE_TYPE_FIELDS):
+                    updated.append(notice_type)
+                else:
+                    unchanged += 1
+            if created:
+                cls._default_manager.bulk_create(created)
+            if updated:
+                _bulk_update(cls, updated, NOTICE_TYPE_FIELDS)
+
+        if created or updated:
+            # bulk operations do not send post_save
+            invalidate_preferences()
+        if verbosity > 1:
+            for action, notice_types in [("Created", created), ("Updated", updated)]:
+                for notice_type in notice_types:
+                    print("%s %s NoticeType" % (action, notice_type.label))
+        return {"created": len(created), "updated": len(updated), "unchanged": unchanged}
+
+
+def _apply_changes(obj, values, fields):
+    """
+    Sets ``fields`` of ``obj`` from ``values``, returning whether any changed.
+    """
+    changed = False
+    for field in fields:
+        if getattr(obj, field) != values[field]:
+            setattr(obj, field, values[field])
+            changed = True
+    return changed
+
+
+def _notice_type_spec(spec):
+    if isinstance(spec, dict):
+        return _notice_type_values(**spec)
+    return _notice_type_values(*spec)
+
+
+def _notice_type_values(label, display, description, permission='', default=2,
+                        recipient_invariant=False):
+    return {
+        "label": label,
+        "display": display,
+        "description": description,
+        "permission": permission,
+        "default": default,
+        "recipient_invariant": recipient_invariant,
+    }
+
+
+def _bulk_update(model, objs, fields):
+    """
+    Updates ``fields`` of ``objs`` with a single UPDATE statement.
+    """
+    if hasattr(QuerySet, "bulk_update"):
+        model._default_manager.bulk_update(objs, fields)
+        return
+    model._default_manager.filter(pk__in=[obj.pk for obj in objs]).update(**dict(
+        (field, Case(
+            *[When(pk=obj.pk, then=Value(getattr(obj, field))) for obj in objs],
+            output_field=model._meta.get_field(field)
+        ))
+        for field in fields
+    ))
+
 
 class NoticeSetting(models.Model):
     """
@@ -115,8 +214,155 @@ class NoticeQueueBatch(models.Model):
     """
     A queued notice.
     Denormalized data for a notice.
+
+    The label, recipient count (None for an audience, resolved when emitted),
+    priority and creation time are kept alongside the payload so the queue
+    can be inspected with aggregate queries.
     """
     pickled_data = models.TextField()
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    label = models.CharField(max_length=40, blank=True, db_index=True)
+    recipient_count = models.PositiveIntegerField(null=True)
+    priority = models.SmallIntegerField(default=0, db_index=True)
+
+    @classmethod
+    def encode(cls, recipients, label, extra_context, sender, priority=0):
+        """
+        Returns an unsaved batch of notices to ``recipients``, a list of user
+        primary keys or an ``Audience``.
+        """
+        return cls(
+            pickled_data=encode_batch(recipients, label, extra_context, sender),
+            label=label,
+            recipient_count=None if isinstance(recipients, Audience) else len(recipients),
+            priority=priority
+        )
+
+
+class NoticeLock(models.Model):
+    """
+    A lease held by an ``emit_notices`` run when using
+    ``pinax.notifications.locks.DatabaseLock``.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    owner = models.CharField(max_length=255)
+    expires_at = models.DateTimeField()
+
+
+class NoticeSubscriptionIndex(models.Model):
+    """
+    A user's unscoped settings for one medium as two bitsets indexed by
+    notice type pk: the types turned on and the types with a setting at all.
+    Maintained when ``PINAX_NOTIFICATIONS_SUBSCRIPTION_INDEX`` is enabled.
+    """
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name="+", on_delete=models.CASCADE)
+    medium = models.CharField(max_length=100)
+    enabled = models.BinaryField(default=b"")
+    configured = models.BinaryField(default=b"")
+
+    class Meta:
+        unique_together = ("user", "medium")
+
+
+class StoredNotice(models.Model):
+    """
+    A notice delivered by ``pinax.notifications.backends.stored.StoredBackend``
+    for display on site.
+    """
+    recipient = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name="stored_notices", on_delete=models.CASCADE)
+    sender = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, related_name="+",
+        on_delete=models.SET_NULL)
+    notice_type = models.ForeignKey(NoticeType, on_delete=models.CASCADE)
+    message = models.TextField()
+    added = models.DateTimeField(default=timezone.now)
+    unread = models.BooleanField(default=True)
+
+    class Meta:
+        index_together = [("recipient", "unread")]
+
+    @classmethod
+    def for_user(cls, user, before=None, limit=20, unread=None):
+        """
+        Returns up to ``limit`` of the user's notices, newest first, older
+        than the notice with pk ``before`` when given. Pass the pk of the
+        last notice of a page as ``before`` to get the next page.
+        """
+        notices = cls._default_manager.filter(recipient=user)
+        if unread is not None:
+            notices = notices.filter(unread=unread)
+        if before is not None:
+            notices = notices.filter(pk__lt=before)
+        return list(notices.select_related("notice_type").order_by("-pk")[:limit])
+
+    @classmethod
+    def unread_count(cls, user):
+        return NoticeCounter.objects.filter(user=user).values_list("unread", flat=True).first() or 0
+
+    @classmethod
+    def mark_read(cls, user, pks=None):
+        """
+        Marks the user's notices with the given pks, or all of them, as read
+        and returns how many were unread.
+        """
+        with transaction.atomic():
+            notices = cls._default_manager.filter(recipient=user, unread=True)
+            if pks is not None:
+                notices = notices.filter(pk__in=pks)
+            count = notices.update(unread=False)
+            if count:
+                NoticeCounter.objects.filter(user=user).update(
+                    unread=Greatest(F("unread") - count, 0))
+        return count
+
+
+class NoticeCounter(models.Model):
+    """
+    The number of unread ``StoredNotice`` rows of a user, kept up to date by
+    atomic increments and decrements so it never has to be counted.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, primary_key=True, related_name="+",
+        on_delete=models.CASCADE)
+    unread = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def increment(cls, user_pks):
+        """
+        Adds one unread notice for every occurrence of a user pk.
+        """
+        counts = Counter(user_pks)
+        with transaction.atomic():
+            existing = set(cls.objects.filter(user__in=list(counts)).values_list("user_id", flat=True))
+            by_count = {}
+            for user_pk in existing:
+                by_count.setdefault(counts[user_pk], []).append(user_pk)
+            for count, pks in by_count.items():
+                cls.objects.filter(user__in=pks).update(unread=F("unread") + count)
+            missing = [
+                cls(user_id=user_pk, unread=count)
+                for user_pk, count in counts.items() if user_pk not in existing
+            ]
+            if not missing:
+                return
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(missing)
+            except IntegrityError:
+                # somebody else created some of them concurrently
+                for counter in missing:
+                    cls.objects.get_or_create(user_id=counter.user_id)
+                    cls.objects.filter(user_id=counter.user_id).update(
+                        unread=F("unread") + counter.unread)
+
+
+@receiver(post_delete, sender=StoredNotice)
+def stored_notice_deleted(sender, instance, **kwargs):
+    if instance.unread:
+        NoticeCounter.objects.filter(user_id=instance.recipient_id).update(
+            unread=Greatest(F("unread") - 1, 0))
 
 
 def get_notification_language(user):
@@ -136,48 +382,95 @@ def get_notification_language(user):
     raise LanguageStoreNotAvailable
 
 
-def send_now(users, label, extra_context=None, sender=None, scoping=None):
+def _group_by_language(users, label):
     """
-    Creates a new notice.
-
-    This is intended to be how other apps create new notices.
-
-    notification.send(user, "friends_invite_sent", {
-        "spam": "eggs",
-        "foo": "bar",
-    )
+    Groups ``users`` by the language of their notices, from the language
+    store defined in the NOTIFICATION_LANGUAGE_MODULE setting.
+    """
+    groups = OrderedDict()
+    with metrics.timer("activate_language", label=label):
+        for user in users:
+            try:
+                language = get_notification_language(user)
+            except LanguageStoreNotAvailable:
+                language = None
+            groups.setdefault(language, []).append(user)
+    return groups
+
+
+def _send_to_users(users, backends, notice_type, extra_context, sender, scoping):
+    """
+    Delivers to the users each backend can send to, one ``deliver_many``
+    call per backend and language. Returns the pks of the users notified.
+    """
+    label = notice_type.label
+    current_language = get_language()
+    notified = set()
+    for language, group in _group_by_language(users, label).items():
+        activate(language or current_language)
+        for backend in backends:
+            tags = {"label": label, "backend": backend.medium_id}
+            with metrics.timer("can_send", **tags):
+                recipients = [
+                    user for user in group
+                    if backend.can_send(user, notice_type, scoping=scoping)
+                ]
+            if not recipients:
+                continue
+            with metrics.timer("deliver", **tags):
+                backend.deliver_many(recipients, sender, notice_type, extra_context)
+            metrics.incr("delivered", len(recipients), **tags)
+            notified.update(user.pk for user in recipients)
+    return notified
+
+
+def _send_now(users, label, extra_context=None, sender=None, scoping=None, media=None):
+    """
+    Like ``send_now`` but returns the number of users notified, optionally
+    only through the backends of ``media``.
     """
-    sent = False
     if extra_context is None:
         extra_context = {}
+    if isinstance(users, Audience):
+        media = media or users.media
+        scoping = scoping or users.scoping
 
     try:
         notice_type = NoticeType.objects.get(label=label)
     except NoticeType.DoesNotExist:
-        return sent
+        return 0
 
     current_language = get_language()
+    backends = [
+        backend for backend in settings.PINAX_NOTIFICATIONS_BACKENDS.values()
+        if media is None or backend.medium_id in media
+    ]
+    media = [backend.medium_id for backend in backends]
+
+    notified = 0
+    with metrics.timer("send_now", label=label):
+        for chunk in chunked(users, settings.PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE):
+            with prefetch_notice_settings(chunk, notice_type, media, scoping):
+                notified += len(_send_to_users(
+                    chunk, backends, notice_type, extra_context, sender, scoping))
 
-    for user in users:
-        # get user language for user from language store defined in
-        # NOTIFICATION_LANGUAGE_MODULE setting
-        try:
-            language = get_notification_language(user)
-        except LanguageStoreNotAvailable:
-            language = None
+    # reset environment to original language
+    activate(current_language)
+    return notified
 
-        if language is not None:
-            # activate the user's language
-            activate(language)
 
-        for backend in settings.PINAX_NOTIFICATIONS_BACKENDS.values():
-            if backend.can_send(user, notice_type, scoping=scoping):
-                backend.deliver(user, sender, notice_type, extra_context)
-                sent = True
+def send_now(users, label, extra_context=None, sender=None, scoping=None):
+    """
+    Creates a new notice.
 
-    # reset environment to original language
-    activate(current_language)
-    return sent
+    This is intended to be how other apps create new notices.
+
+    notification.send(user, "friends_invite_sent", {
+        "spam": "eggs",
+        "foo": "bar",
+    )
+    """
+    return bool(_send_now(users, label, extra_context, sender, scoping))
 
 
 def send(*args, **kwargs):
@@ -201,19 +494,72 @@ def send(*args, **kwargs):
             return send_now(*args, **kwargs)
 
 
-def queue(users, label, extra_context=None, sender=None):
+def send_to_subscribers(label, medium=None, scoping=None, extra_context=None, sender=None,
+                        **kwargs):
+    """
+    Notifies every user opted in to ``label`` on ``medium`` (on any medium
+    when None), without passing a list of users. The subscribers are found
+    with a single query, walked in chunks, and notified on ``medium`` only.
+
+    Like ``send``, this honors ``PINAX_NOTIFICATIONS_QUEUE_ALL`` and the
+    ``queue`` and ``now`` keyword arguments; when queued, only the audience
+    is stored.
+    """
+    audience = Audience.subscribers(label, medium, scoping)
+    return send(audience, label, extra_context, sender, **kwargs)
+
+
+def queue(users, label, extra_context=None, sender=None, priority=0):
     """
     Queue the notification in NoticeQueueBatch. This allows for large amounts
     of user notifications to be deferred to a seperate process running outside
     the webserver.
+
+    Recipients are streamed and split into batches of at most
+    ``PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE`` notices so that no single row
+    (or worker) has to carry the whole fan-out.
+
+    ``users`` may also be an ``Audience``, in which case only the audience
+    description is stored and recipients are resolved by ``emit_notices``.
+
+    ``priority`` is recorded on the batches for ``emit_stats``.
+
+    With ``PINAX_NOTIFICATIONS_QUEUE_OUTBOX`` enabled, notices queued inside
+    a transaction are only written once it commits; see ``outbox``.
     """
     if extra_context is None:
         extra_context = {}
+    if settings.PINAX_NOTIFICATIONS_QUEUE_OUTBOX:
+        if outbox.defer(users, label, extra_context, sender, priority):
+            return
+    if isinstance(users, Audience):
+        save_batches([NoticeQueueBatch.encode(users, label, extra_context, sender, priority)])
+        return
     if isinstance(users, QuerySet):
-        users = [row["pk"] for row in users.values("pk")]
+        pks = users.values_list("pk", flat=True).iterator()
     else:
-        users = [user.pk for user in users]
-    notices = []
-    for user in users:
-        notices.append((user, label, extra_context, sender))
-    NoticeQueueBatch(pickled_data=base64.b64encode(pickle.dumps(notices))).save()
+        pks = (user.pk for user in users)
+    save_batches([
+        NoticeQueueBatch.encode(chunk, label, extra_context, sender, priority)
+        for chunk in chunked(pks, settings.PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE)
+    ])
+
+
+def save_batches(batches, using=None):
+    """
+    Writes ``batches`` with one query and wakes up the workers.
+    """
+    if batches:
+        NoticeQueueBatch.objects.using(using).bulk_create(batches)
+        _notify_queued(using)
+
+
+def _notify_queued(using=None):
+    """
+    Wakes up ``emit_notices --loop`` workers listening on PostgreSQL. The
+    notification is only delivered once the current transaction commits.
+    """
+    connection = connections[using or router.db_for_write(NoticeQueueBatch)]
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("NOTIFY {0}".format(QUEUE_CHANNEL))
@@ -0,0 +1,117 @@
+"""
+Transaction-aware buffering of queued notices.
+
+With ``PINAX_NOTIFICATIONS_QUEUE_OUTBOX`` enabled, ``queue()`` calls made
+inside a transaction are held in an outbox instead of writing a
+``NoticeQueueBatch`` row each. There is one outbox per savepoint that queues
+notices (the outermost block counting as one), flushed from
+``transaction.on_commit`` with a single ``bulk_create``: notices sharing a
+label, extra context and sender are merged into the same batches. Notices
+queued inside a savepoint that is rolled back are dropped along with it, and
+nothing is written if the whole transaction rolls back.
+
+Outside of a transaction ``queue()`` writes immediately, as before.
+"""
+import threading
+import weakref
+
+from collections import OrderedDict
+
+from django.db import connections, router, transaction
+from django.db.models.query import QuerySet
+from django.utils.six.moves import cPickle as pickle  # pylint: disable-msg=F
+
+from .audiences import Audience
+from .conf import settings
+from .payload import dehydrate
+from .utils import chunked
+
+
+_local = threading.local()
+
+
+class Entry(object):
+    """
+    The notices of one ``queue()`` call.
+    """
+
+    def __init__(self, recipients, label, extra_context, sender, priority):
+        self.recipients = recipients
+        self.priority = priority
+        # snapshot of the shared arguments, also used to merge entries
+        self.key = pickle.dumps(dehydrate((label, extra_context, sender)))
+
+
+class Outbox(object):
+    """
+    The notices queued within one savepoint of a transaction.
+
+    The only strong reference to an outbox is the ``on_commit`` callback
+    flushing it, so when Django discards the callback because the savepoint
+    or transaction rolled back, the outbox goes away with it.
+    """
+
+    def __init__(self, using):
+        self.using = using
+        self.entries = []
+
+    def batches(self):
+        from .models import NoticeQueueBatch
+
+        merged = OrderedDict()
+        for entry in self.entries:
+            if isinstance(entry.recipients, Audience):
+                merged[id(entry)] = (entry, entry.recipients)
+            else:
+                merged.setdefault((entry.key, entry.priority), (entry, []))[1].extend(entry.recipients)
+        for entry, recipients in merged.values():
+            label, extra_context, sender = pickle.loads(entry.key)
+            if isinstance(recipients, Audience):
+                chunks = [recipients]
+            else:
+                chunks = chunked(recipients, settings.PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE)
+            for chunk in chunks:
+                yield NoticeQueueBatch.encode(chunk, label, extra_context, sender, entry.priority)
+
+    def flush(self):
+        from .models import save_batches
+
+        batches = list(self.batches())
+        self.entries = []
+        save_batches(batches, using=self.using)
+
+
+def get_outbox(connection):
+    """
+    Returns the outbox of the current savepoint on ``connection``, starting
+    one, flushed when the transaction commits, if there is none yet.
+    """
+    outboxes = _local.__dict__.get("outboxes")
+    if outboxes is None:
+        outboxes = _local.outboxes = weakref.WeakValueDictionary()
+    key = (connection.alias, tuple(connection.savepoint_ids))
+    outbox = outboxes.get(key)
+    if outbox is None:
+        outbox = outboxes[key] = Outbox(connection.alias)
+        transaction.on_commit(outbox.flush, using=connection.alias)
+    return outbox
+
+
+def defer(users, label, extra_context, sender, priority=0):
+    """
+    Buffers the notices in the outbox of the current transaction. Returns
+    False, leaving the write to the caller, when no transaction is active.
+    """
+    from .models import NoticeQueueBatch
+
+    connection = connections[router.db_for_write(NoticeQueueBatch)]
+    if not connection.in_atomic_block:
+        return False
+    if isinstance(users, Audience):
+        recipients = users
+    elif isinstance(users, QuerySet):
+        recipients = list(users.values_list("pk", flat=True))
+    else:
+        recipients = [user.pk for user in users]
+    get_outbox(connection).entries.append(Entry(recipients, label, extra_context, sender, priority))
+    return True
@@ -0,0 +1,251 @@
+"""
+Encoding of queued batches.
+
+A batch is stored as a single header holding the label, extra context and
+sender shared by every notice, followed by the recipients packed as an
+array of 64-bit integers (or an ``Audience``). Payloads larger than
+``PINAX_NOTIFICATIONS_QUEUE_COMPRESSION_THRESHOLD`` bytes are compressed.
+
+Model instances in the sender, extra context and audience arguments are
+stored as ``(content type, pk)`` references and loaded fresh, with one
+query per model per batch, when the batch is decoded.
+
+Rows written by older versions, a pickled list of
+``(user, label, extra_context, sender)`` tuples, are still decoded.
+"""
+import array
+import base64
+import sys
+import zlib
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models
+from django.utils.six.moves import cPickle as pickle  # pylint: disable-msg=F
+
+from django.contrib.contenttypes.models import ContentType
+
+from .audiences import Audience
+from .conf import settings, is_installed
+
+
+MAGIC = b"PNQ"
+VERSION = 1
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+CODECS = {
+    None: CODEC_NONE,
+    "zlib": CODEC_ZLIB,
+    "zstd": CODEC_ZSTD,
+}
+
+
+def compress(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data)
+    if codec == CODEC_ZSTD:
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decompress(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_ZSTD:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def get_codec():
+    name = settings.PINAX_NOTIFICATIONS_QUEUE_COMPRESSION
+    if name not in CODECS:
+        raise ImproperlyConfigured(
+            "PINAX_NOTIFICATIONS_QUEUE_COMPRESSION must be one of None, 'zlib' or 'zstd'"
+        )
+    if name == "zstd" and not is_installed("zstandard"):
+        raise ImproperlyConfigured("zstd compression requires the zstandard package")
+    return CODECS[name]
+
+
+def pack_recipients(pks):
+    """
+    Packs integer primary keys as little-endian 64-bit integers; any other
+    kind of primary key is kept as a list.
+    """
+    if not all(isinstance(pk, int) for pk in pks):
+        return list(pks)
+    packed = array.array("q", pks)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_recipients(recipients):
+    if not isinstance(recipients, bytes):
+        return recipients
+    packed = array.array("q")
+    packed.frombytes(recipients)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tolist()
+
+
+class ModelReference(object):
+    """
+    A lightweight stand-in for a saved model instance.
+    """
+
+    __slots__ = ("content_type_id", "pk")
+
+    def __init__(self, content_type_id, pk):
+        self.content_type_id = content_type_id
+        self.pk = pk
+
+    def __getstate__(self):
+        return (self.content_type_id, self.pk)
+
+    def __setstate__(self, state):
+        self.content_type_id, self.pk = state
+
+    def __eq__(self, other):
+        if not isinstance(other, ModelReference):
+            return False
+        return (self.content_type_id, self.pk) == (other.content_type_id, other.pk)
+
+    def __hash__(self):
+        return hash((self.content_type_id, self.pk))
+
+
+def _walk(value, replace):
+    """
+    Rebuilds ``value`` with ``replace`` applied to every leaf inside
+    dicts, lists and tuples. Subclasses of those are left alone.
+    """
+    if type(value) is dict:
+        return dict((key, _walk(item, replace)) for key, item in value.items())
+    if type(value) is list:
+        return [_walk(item, replace) for item in value]
+    if type(value) is tuple:
+        return tuple(_walk(item, replace) for item in value)
+    if isinstance(value, Audience):
+        audience = Audience(value.name)
+        audience.args = _walk(value.args, replace)
+        audience.kwargs = _walk(value.kwargs, replace)
+        audience.media = value.media
+        audience.scoping = _walk(value.scoping, replace)
+        return audience
+    return replace(value)
+
+
+def dehydrate(value):
+    """
+    Replaces saved model instances within ``value`` with references.
+    """
+    def replace(item):
+        if isinstance(item, models.Model) and item.pk is not None:
+            content_type = ContentType.objects.get_for_model(item, for_concrete_model=False)
+            return ModelReference(content_type.pk, item.pk)
+        return item
+    return _walk(value, replace)
+
+
+def rehydrate(value):
+    """
+    Replaces the references within ``value`` with fresh instances, loaded
+    with one query per model. References to deleted rows become None.
+    """
+    references = {}
+
+    def collect(item):
+        if isinstance(item, ModelReference):
+            references.setdefault(item.content_type_id, set()).add(item.pk)
+        return item
+    _walk(value, collect)
+    if not references:
+        return value
+
+    instances = {}
+    for content_type_id, pks in references.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        for pk, instance in model._default_manager.in_bulk(list(pks)).items():
+            instances[ModelReference(content_type_id, pk)] = instance
+
+    def replace(item):
+        if isinstance(item, ModelReference):
+            return instances.get(item)
+        return item
+    return _walk(value, replace)
+
+
+def encode_batch(recipients, label, extra_context, sender):
+    """
+    Encodes one batch of notices sharing ``label``, ``extra_context`` and
+    ``sender``. ``recipients`` is a list of user primary keys or an
+    ``Audience``.
+    """
+    if isinstance(recipients, list):
+        recipients = pack_recipients(recipients)
+    extra_context, sender, recipients = dehydrate((extra_context, sender, recipients))
+    data = pickle.dumps({
+        "label": label,
+        "extra_context": extra_context,
+        "sender": sender,
+        "recipients": recipients,
+    })
+    codec = CODEC_NONE
+    if len(data) >= settings.PINAX_NOTIFICATIONS_QUEUE_COMPRESSION_THRESHOLD:
+        codec = get_codec()
+        data = compress(codec, data)
+    header = MAGIC + bytearray([VERSION, codec])
+    return base64.b64encode(bytes(header) + data).decode("ascii")
+
+
+def _load(data):
+    """
+    Returns the header of a batch as a dict, or its list of notices for a
+    row written by an older version.
+    """
+    raw = base64.b64decode(data)
+    if not raw.startswith(MAGIC):
+        return pickle.loads(raw)
+    version, codec = bytearray(raw[len(MAGIC):len(MAGIC) + 2])
+    if version != VERSION:
+        raise ValueError("unsupported queued batch version {0}".format(version))
+    return pickle.loads(decompress(codec, raw[len(MAGIC) + 2:]))
+
+
+def decode_batch(data):
+    """
+    Returns the ``(user, label, extra_context, sender)`` notices of a batch,
+    where ``user`` is a primary key or an ``Audience``.
+    """
+    batch = _load(data)
+    if isinstance(batch, list):
+        return batch
+    recipients = unpack_recipients(batch["recipients"])
+    if isinstance(recipients, list):
+        extra_context, sender = rehydrate((batch["extra_context"], batch["sender"]))
+    else:
+        extra_context, sender, recipients = rehydrate(
+            (batch["extra_context"], batch["sender"], recipients))
+        recipients = [recipients]
+    return [
+        (recipient, batch["label"], extra_context, sender)
+        for recipient in recipients
+    ]
+
+
+def describe_batch(data):
+    """
+    Returns the label of a batch and its number of recipients, None for an
+    ``Audience``, without loading the objects it references.
+    """
+    batch = _load(data)
+    if isinstance(batch, list):
+        return (batch[0][1] if batch else ""), len(batch)
+    recipients = unpack_recipients(batch["recipients"])
+    return batch["label"], None if isinstance(recipients, Audience) else len(recipients)
@@ -0,0 +1,131 @@
+"""
+Profiling support for ``emit_notices --profile``.
+"""
+from __future__ import division
+
+import cProfile
+import io
+import pstats
+import re
+import time
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from .conf import is_installed
+
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+IN_LIST = re.compile(r"\bIN \((?:\s*(?:\?|%s)\s*,)*\s*(?:\?|%s)\s*\)", re.IGNORECASE)
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    """
+    Reduces a statement to its shape so that executions differing only in
+    their parameters are aggregated together.
+    """
+    sql = STRING_LITERAL.sub("?", sql)
+    sql = NUMBER_LITERAL.sub("?", sql)
+    sql = IN_LIST.sub("IN (...)", sql)
+    return WHITESPACE.sub(" ", sql).strip()
+
+
+class SQLLog(object):
+    """
+    Records every query run within the block with its duration.
+
+    Uses ``connection.execute_wrapper`` where Django provides it and falls
+    back to the debug cursor otherwise, which only keeps the last 9000
+    queries.
+    """
+
+    def __init__(self, using=connection):
+        self.connection = using
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.time() - start))
+
+    def __enter__(self):
+        if hasattr(self.connection, "execute_wrapper"):
+            self.wrapper = self.connection.execute_wrapper(self)
+        else:
+            self.wrapper = CaptureQueriesContext(self.connection)
+        self.wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wrapper.__exit__(*exc_info)
+        if isinstance(self.wrapper, CaptureQueriesContext):
+            self.queries.extend(
+                (query["sql"], float(query["time"])) for query in self.wrapper.captured_queries
+            )
+
+    def aggregate(self):
+        """
+        Returns ``(statement, count, total, max)`` tuples, slowest in total
+        first.
+        """
+        stats = {}
+        for sql, duration in self.queries:
+            statement = normalize_sql(sql)
+            count, total, longest = stats.get(statement, (0, 0, 0))
+            stats[statement] = (count + 1, total + duration, max(longest, duration))
+        return sorted(
+            ((sql,) + values for sql, values in stats.items()),
+            key=lambda row: row[2],
+            reverse=True
+        )
+
+    def report(self):
+        lines = ["{0:>8} {1:>10} {2:>10}  statement".format("count", "total(s)", "max(s)")]
+        for sql, count, total, longest in self.aggregate():
+            lines.append("{0:>8} {1:>10.4f} {2:>10.4f}  {3}".format(count, total, longest, sql))
+        return "\n".join(lines) + "\n"
+
+
+def profile(func, path, limit=40):
+    """
+    Calls ``func`` under a profiler and writes the results next to ``path``:
+
+    * ``path`` - pstats data for cProfile (or the text report of
+      pyinstrument when it is installed, which samples instead of tracing)
+    * ``path.txt`` - the report sorted by cumulative time
+    * ``path.sql.txt`` - the queries aggregated by normalized statement
+
+    Returns the text report.
+    """
+    with SQLLog() as sql_log:
+        if is_installed("pyinstrument"):
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            try:
+                func()
+            finally:
+                profiler.stop()
+            report = profiler.output_text()
+            with open(path, "w") as fp:
+                fp.write(report)
+        else:
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(func)
+            finally:
+                profiler.dump_stats(path)
+            stream = io.StringIO()
+            stats = pstats.Stats(path, stream=stream)
+            stats.sort_stats("cumulative").print_stats(limit)
+            report = stream.getvalue()
+
+    with open(path + ".txt", "w") as fp:
+        fp.write(report)
+    with open(path + ".sql.txt", "w") as fp:
+        fp.write(sql_log.report())
+    return report
@@ -0,0 +1,66 @@
+"""
+Queue introspection.
+
+``queue_stats`` describes the backlog from the metadata columns of
+``NoticeQueueBatch`` with aggregate queries only, without loading or
+decoding any payload, so it is cheap enough to feed worker autoscaling.
+"""
+from django.db.models import Case, Count, IntegerField, Min, Sum, When
+from django.utils import timezone
+
+from .models import NoticeQueueBatch
+
+
+def _age(oldest, now):
+    if oldest is None:
+        return None
+    return max((now - oldest).total_seconds(), 0)
+
+
+def _totals(queryset):
+    return queryset.aggregate(
+        batches=Count("pk"),
+        recipients=Sum("recipient_count"),
+        audiences=Sum(Case(
+            When(recipient_count__isnull=True, then=1), default=0, output_field=IntegerField()
+        )),
+        oldest=Min("created_at")
+    )
+
+
+def _group(queryset, field, now):
+    rows = queryset.values(field).annotate(
+        batches=Count("pk"),
+        recipients=Sum("recipient_count"),
+        oldest=Min("created_at")
+    ).order_by(field)
+    return [
+        {
+            field: row[field],
+            "batches": row["batches"],
+            "recipients": row["recipients"] or 0,
+            "oldest_age": _age(row["oldest"], now),
+        }
+        for row in rows
+    ]
+
+
+def queue_stats(now=None):
+    """
+    Returns the queue depth in batches, the number of queued recipients
+    (audiences, resolved when emitted, are counted apart), the age in
+    seconds of the oldest batch and the same figures per label and per
+    priority.
+    """
+    if now is None:
+        now = timezone.now()
+    batches = NoticeQueueBatch.objects.all()
+    totals = _totals(batches)
+    return {
+        "depth": totals["batches"],
+        "recipients": totals["recipients"] or 0,
+        "audiences": totals["audiences"] or 0,
+        "oldest_age": _age(totals["oldest"], now),
+        "labels": _group(batches, "label", now),
+        "priorities": _group(batches, "priority", now),
+    }
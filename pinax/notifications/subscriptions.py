@@ -0,0 +1,151 @@
+"""
+Optional compact index of notice settings.
+
+With ``PINAX_NOTIFICATIONS_SUBSCRIPTION_INDEX`` enabled, each user's
+unscoped settings for a medium are kept as two bitsets indexed by notice
+type pk in a ``NoticeSubscriptionIndex`` row: ``enabled`` has the types
+turned on and ``configured`` the types having a setting at all, the others
+falling back to the notice type's default. A few bytes per user and medium
+then answer every preference check for that user, so ``can_send`` tests
+bits instead of resolving ``NoticeSetting`` rows. The subscribers audience
+keeps selecting users with a single query on the settings.
+
+The index follows ``NoticeSetting`` saves and deletes; bulk writes refresh
+it explicitly and ``rebuild_subscription_index`` rebuilds it from scratch.
+"""
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from django.contrib.auth import get_user_model
+
+from .conf import settings
+
+
+def index_enabled():
+    return settings.PINAX_NOTIFICATIONS_SUBSCRIPTION_INDEX
+
+
+def test_bit(bits, i):
+    byte = i >> 3
+    return byte < len(bits) and bool(bits[byte] & (1 << (i & 7)))
+
+
+def set_bit(bits, i, value):
+    """
+    Sets or clears bit ``i`` of the bytearray ``bits``, growing it as needed.
+    """
+    byte = i >> 3
+    if byte >= len(bits):
+        if not value:
+            return
+        bits.extend(bytes(byte + 1 - len(bits)))
+    if value:
+        bits[byte] |= 1 << (i & 7)
+    else:
+        bits[byte] &= ~(1 << (i & 7)) & 0xff
+
+
+def refresh_index(user_pks):
+    """
+    Rebuilds the index rows of ``user_pks`` from their unscoped settings.
+    """
+    from .models import NoticeSetting, NoticeSubscriptionIndex
+
+    if not index_enabled():
+        return
+    user_pks = list(user_pks)
+    rows = NoticeSetting.objects.filter(
+        user__in=user_pks,
+        scoping_content_type__isnull=True,
+        scoping_object_id__isnull=True
+    ).values_list("user_id", "notice_type_id", "medium", "send")
+    bitsets = {}
+    for user_pk, notice_type_pk, medium, send in rows:
+        enabled, configured = bitsets.setdefault((user_pk, medium), (bytearray(), bytearray()))
+        set_bit(configured, notice_type_pk, True)
+        set_bit(enabled, notice_type_pk, send)
+    with transaction.atomic():
+        NoticeSubscriptionIndex.objects.filter(user__in=user_pks).delete()
+        NoticeSubscriptionIndex.objects.bulk_create([
+            NoticeSubscriptionIndex(
+                user_id=user_pk, medium=medium, enabled=bytes(enabled), configured=bytes(configured))
+            for (user_pk, medium), (enabled, configured) in bitsets.items()
+        ])
+
+
+def rebuild_index(chunk_size=None):
+    """
+    Rebuilds the index of every user, in chunks. Returns the number of users.
+    """
+    if chunk_size is None:
+        chunk_size = settings.PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE
+    users = get_user_model()._default_manager.order_by("pk").values_list("pk", flat=True)
+    count, last_pk = 0, None
+    while True:
+        chunk = list((users if last_pk is None else users.filter(pk__gt=last_pk))[:chunk_size])
+        if not chunk:
+            return count
+        refresh_index(chunk)
+        count += len(chunk)
+        last_pk = chunk[-1]
+
+
+def update_index(user_pk, notice_type_pk, medium, send):
+    """
+    Records one setting in the index; ``send`` is None for a deleted setting.
+    """
+    from .models import NoticeSubscriptionIndex
+
+    with transaction.atomic():
+        if send is not None:
+            NoticeSubscriptionIndex.objects.get_or_create(user_id=user_pk, medium=medium)
+        row = NoticeSubscriptionIndex.objects.select_for_update().filter(
+            user_id=user_pk, medium=medium).first()
+        if row is None:
+            return
+        enabled, configured = bytearray(row.enabled), bytearray(row.configured)
+        set_bit(configured, notice_type_pk, send is not None)
+        set_bit(enabled, notice_type_pk, bool(send))
+        row.enabled, row.configured = bytes(enabled), bytes(configured)
+        row.save(update_fields=["enabled", "configured"])
+
+
+def subscriptions_for_users(user_pks, notice_types, media, defaults):
+    """
+    Returns whether each user has each notice type turned on for each
+    medium, keyed by ``(user pk, notice type pk, medium)``, with one query.
+    ``defaults`` maps media to their spam sensitivity.
+    """
+    from .models import NoticeSubscriptionIndex
+
+    rows = NoticeSubscriptionIndex.objects.filter(
+        user__in=user_pks, medium__in=media
+    ).values_list("user_id", "medium", "enabled", "configured")
+    bitsets = dict(
+        ((user_pk, medium), (bytes(enabled), bytes(configured)))
+        for user_pk, medium, enabled, configured in rows
+    )
+    subscribed = {}
+    for user_pk in user_pks:
+        for medium in media:
+            enabled, configured = bitsets.get((user_pk, medium), (b"", b""))
+            for notice_type in notice_types:
+                if test_bit(configured, notice_type.pk):
+                    send = test_bit(enabled, notice_type.pk)
+                else:
+                    send = defaults[medium] <= notice_type.default
+                subscribed[(user_pk, notice_type.pk, medium)] = send
+    return subscribed
+
+
+@receiver(post_save, sender="pinax_notifications.NoticeSetting")
+def notice_setting_saved(sender, instance, **kwargs):
+    if index_enabled() and instance.scoping_content_type_id is None:
+        update_index(instance.user_id, instance.notice_type_id, instance.medium, instance.send)
+
+
+@receiver(post_delete, sender="pinax_notifications.NoticeSetting")
+def notice_setting_deleted(sender, instance, **kwargs):
+    if index_enabled() and instance.scoping_content_type_id is None:
+        update_index(instance.user_id, instance.notice_type_id, instance.medium, None)
@@ -1,6 +1,60 @@
+import os
+import shutil
+import tempfile
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from django.contrib.auth import get_user_model
+
+
 def get_backend_id(backend_name):
     from ..models import NOTICE_MEDIA
     for bid, bname in NOTICE_MEDIA:
         if bname == backend_name:
             return bname
     return None
+
+
+class QueryBudgetMixin(object):
+    """
+    Asserts that the number of queries does not grow with the input size,
+    showing the SQL of both runs on failure.
+    """
+
+    def capture(self, func):
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        return queries.captured_queries
+
+    def assertConstantQueries(self, small, large):
+        small_queries = self.capture(small)
+        large_queries = self.capture(large)
+        if len(small_queries) != len(large_queries):
+            self.fail("{0} queries for the small input but {1} for the large one.\n\n"
+                      "Small:\n{2}\n\nLarge:\n{3}".format(
+                          len(small_queries),
+                          len(large_queries),
+                          "\n".join(q["sql"] for q in small_queries),
+                          "\n".join(q["sql"] for q in large_queries)))
+        return len(large_queries)
+
+
+def create_users(prefix, count):
+    User = get_user_model()
+    User.objects.bulk_create([
+        User(username="{0}{1}".format(prefix, i), email="{0}{1}@user.com".format(prefix, i))
+        for i in range(count)
+    ])
+    return list(User.objects.filter(username__startswith=prefix).order_by("pk"))
+
+
+def use_temp_directory(test_case):
+    """
+    Runs the rest of ``test_case`` in a temporary working directory, where
+    ``emit_notices`` leaves its lock file, removed at cleanup.
+    """
+    directory = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, directory)
+    test_case.addCleanup(os.chdir, os.getcwd())
+    os.chdir(directory)
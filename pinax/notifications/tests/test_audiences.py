@@ -0,0 +1,91 @@
+from django.core import management, mail
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from django.contrib.auth import get_user_model
+
+from ..audiences import Audience, register, registry
+from ..models import NoticeType, NoticeQueueBatch, NoticeSetting, queue, send_to_subscribers
+
+from . import get_backend_id, use_temp_directory
+
+
+class TestAudience(TestCase):
+    def setUp(self):
+        use_temp_directory(self)
+        self.users = [
+            get_user_model().objects.create_user("user{0}".format(i), "user{0}@user.com".format(i))
+            for i in range(5)
+        ]
+        NoticeType.create("label", "display", "description")
+
+    def tearDown(self):
+        registry.pop("even", None)
+
+    def test_filter_chunks(self):
+        audience = Audience.filter(username__startswith="user")
+        chunks = list(audience.chunks(2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual([user for chunk in chunks for user in chunk], self.users)
+
+    def test_registered_audience(self):
+        register("even")(lambda: [user for user in self.users if user.pk % 2 == 0])
+        audience = Audience("even")
+        self.assertEqual(list(audience), [user for user in self.users if user.pk % 2 == 0])
+        self.assertEqual([len(chunk) for chunk in audience.chunks(1)], [1] * len(list(audience)))
+
+    def test_unknown_audience(self):
+        with self.assertRaises(ImproperlyConfigured):
+            list(Audience("unknown"))
+
+    @override_settings(SITE_ID=1, PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE=2)
+    def test_queue_audience(self):
+        queue(Audience.filter(username__in=["user1", "user3"]), "label")
+        self.assertEqual(NoticeQueueBatch.objects.count(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+        get_user_model().objects.create_user("user6", "user6@user.com")
+        management.call_command("emit_notices")
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ["user1@user.com", "user3@user.com"])
+
+
+@override_settings(SITE_ID=1)
+class TestSubscribers(TestCase):
+    def setUp(self):
+        use_temp_directory(self)
+        self.users = [
+            get_user_model().objects.create_user("user{0}".format(i), "user{0}@user.com".format(i))
+            for i in range(4)
+        ]
+        NoticeType.create("label", "display", "description")
+        self.notice_type = NoticeType.objects.get(label="label")
+        self.medium = get_backend_id("email")
+        for user, send in [(self.users[0], False), (self.users[1], True)]:
+            NoticeSetting.objects.create(
+                user=user, notice_type=self.notice_type, medium=self.medium, send=send)
+
+    def test_subscribers(self):
+        audience = Audience.subscribers("label", self.medium)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(audience.resolve().order_by("pk")), self.users[1:])
+        self.assertEqual(audience.media, [self.medium])
+        self.assertEqual(list(Audience.subscribers("label")), self.users[1:])
+        self.assertEqual(list(Audience.subscribers("unknown")), [])
+
+    def test_subscribers_default_off(self):
+        NoticeType.create("label", "display", "description", default=1)
+        self.assertEqual(list(Audience.subscribers("label", self.medium)), [self.users[1]])
+
+    def test_send_to_subscribers(self):
+        send_to_subscribers("label", self.medium)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         [user.email for user in self.users[1:]])
+
+    def test_send_to_subscribers_queued(self):
+        send_to_subscribers("label", self.medium, queue=True)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+        management.call_command("emit_notices")
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         [user.email for user in self.users[1:]])
@@ -0,0 +1,104 @@
+from django.core import mail
+from django.core.cache import cache
+from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
+
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+
+from ..cache import LRUCache, get_preference_cache
+from ..models import NoticeType, NoticeSetting, send_now
+from ..utils import notice_settings_for_users
+from ..views import NoticeSettingsView
+
+from . import get_backend_id
+
+
+class TestLRUCache(TestCase):
+
+    def test_eviction(self):
+        lru = LRUCache(2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        self.assertEqual(lru.get("a"), 1)
+        lru.set("c", 3)
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("a"), 1)
+        self.assertEqual(lru.get("c"), 3)
+        self.assertEqual(len(lru), 2)
+
+
+@override_settings(SITE_ID=1, PINAX_NOTIFICATIONS_PREFERENCE_CACHE="default")
+class TestPreferenceCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = [
+            get_user_model().objects.create_user("user{0}".format(i), "user{0}@user.com".format(i))
+            for i in range(3)
+        ]
+        NoticeType.create("label", "display", "description")
+        self.notice_type = NoticeType.objects.get(label="label")
+        self.email_id = get_backend_id("email")
+        Site.objects.get_current()
+
+    def resolve(self):
+        return notice_settings_for_users(self.users, [self.notice_type], [self.email_id])
+
+    def test_send_now_from_cache(self):
+        send_now(self.users, "label")
+        get_preference_cache().lru.clear()
+        with self.assertNumQueries(1):
+            send_now(self.users, "label")
+        self.assertEqual(len(mail.outbox), 6)
+
+    def test_cached_settings(self):
+        first = self.resolve()
+        with self.assertNumQueries(0):
+            second = self.resolve()
+        self.assertEqual(
+            dict((key, (setting.pk, setting.send)) for key, setting in first.items()),
+            dict((key, (setting.pk, setting.send)) for key, setting in second.items()))
+
+    def test_invalidated_on_save(self):
+        self.resolve()
+        setting = NoticeSetting.objects.get(user=self.users[0])
+        setting.send = False
+        setting.save()
+        with self.assertNumQueries(1):
+            resolved = self.resolve()
+        self.assertFalse(resolved[(self.users[0].pk, self.notice_type.pk, self.email_id)].send)
+        self.assertTrue(resolved[(self.users[1].pk, self.notice_type.pk, self.email_id)].send)
+
+    def test_invalidated_on_notice_type_change(self):
+        self.resolve()
+        NoticeType.create("label", "display", "description", default=1)
+        with self.assertNumQueries(1):
+            self.resolve()
+
+    def test_invalidated_by_settings_view(self):
+        self.resolve()
+        request = RequestFactory().post("/notifications/settings/", {})
+        request.user = self.users[0]
+        NoticeSettingsView.as_view()(request)
+        resolved = self.resolve()
+        self.assertFalse(resolved[(self.users[0].pk, self.notice_type.pk, self.email_id)].send)
+        self.assertTrue(resolved[(self.users[1].pk, self.notice_type.pk, self.email_id)].send)
+
+    def test_version_eviction(self):
+        self.resolve()
+        cache.delete(get_preference_cache().version_key(self.users[0].pk))
+        get_preference_cache().lru.clear()
+        with self.assertNumQueries(1):
+            self.resolve()
+
+    @override_settings(
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "dummy": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"},
+        },
+        PINAX_NOTIFICATIONS_PREFERENCE_CACHE="dummy"
+    )
+    def test_cache_keeping_nothing(self):
+        send_now(self.users, "label")
+        send_now(self.users, "label")
+        self.assertEqual(len(mail.outbox), 6)
@@ -1,14 +1,39 @@
+import base64
+import json
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from datetime import timedelta
+from importlib import import_module
+from io import StringIO
+from unittest import mock
+
+from django.apps import apps
 from django.core import management, mail
+from django.db import connection
 from django.test import TestCase
 from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.six.moves import cPickle as pickle
 
 from django.contrib.auth import get_user_model
 
-from ..models import NoticeType, queue
+from ..audiences import Audience
+from ..engine import QueueWaiter, next_interval, queued_batches, recycle_connections
+from ..models import NoticeType, NoticeQueueBatch, queue
+from ..profiling import normalize_sql
+from ..stats import queue_stats
+
+from . import use_temp_directory
 
 
 class TestManagementCmd(TestCase):
     def setUp(self):
+        use_temp_directory(self)
         self.user = get_user_model().objects.create_user("test_user", "test@user.com", "123456")
         self.user2 = get_user_model().objects.create_user("test_user2", "test2@user.com", "123456")
         NoticeType.create("label", "display", "description")
@@ -21,3 +46,202 @@ class TestManagementCmd(TestCase):
         self.assertEqual(len(mail.outbox), 2)
         self.assertIn(self.user.email, mail.outbox[0].to)
         self.assertIn(self.user2.email, mail.outbox[1].to)
+
+    @override_settings(SITE_ID=1, PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE=1)
+    def test_emit_notices_loop_recycles(self):
+        queue([self.user, self.user2], "label")
+        management.call_command("emit_notices", loop=True, max_batches=1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 1)
+
+    @override_settings(SITE_ID=1, PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE=2)
+    def test_emit_notices_max_notices(self):
+        users = [
+            get_user_model().objects.create_user("user{0}".format(i), "user{0}@user.com".format(i))
+            for i in range(3)
+        ]
+        queue(users + [self.user, self.user2], "label")
+        with self.assertLogs(level="INFO") as logs:
+            management.call_command("emit_notices", max_notices=3)
+        # the second batch is finished even though it goes over budget
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 1)
+        self.assertIn("INFO:root:1 batches remaining", logs.output)
+
+    @override_settings(SITE_ID=1, PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE=1)
+    def test_emit_notices_max_seconds(self):
+        queue([self.user, self.user2], "label")
+        management.call_command("emit_notices", max_seconds=0)
+        self.assertEqual(len(mail.outbox), 0)
+        management.call_command("emit_notices", loop=True, max_notices=1)
+        self.assertEqual(len(mail.outbox), 1)
+        management.call_command("emit_notices", loop=True, max_seconds=0.1, min_interval=0.05)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+
+    @override_settings(SITE_ID=1)
+    def test_emit_notices_loop_sigterm(self):
+        if threading.current_thread().name != "MainThread":
+            self.skipTest("signal handlers are only installed in the main thread")
+        queue([self.user], "label")
+        previous = signal.getsignal(signal.SIGTERM)
+        done = threading.Event()
+
+        def terminate():
+            # deliver SIGTERM to the loop's handler once it is installed,
+            # without signalling the test runner itself
+            while not done.wait(0.01):
+                handler = signal.getsignal(signal.SIGTERM)
+                if handler is not previous:
+                    handler(signal.SIGTERM, None)
+                    return
+
+        thread = threading.Thread(target=terminate)
+        thread.start()
+        start = time.time()
+        try:
+            # max_seconds only bounds the test should the handler never run
+            management.call_command(
+                "emit_notices", loop=True, min_interval=0.05, max_interval=0.1, max_seconds=10)
+        finally:
+            done.set()
+            thread.join()
+        self.assertLess(time.time() - start, 10)
+        self.assertIs(signal.getsignal(signal.SIGTERM), previous)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+
+    def test_next_interval(self):
+        self.assertEqual(next_interval(8, True, 0.5, 30), 0.5)
+        self.assertEqual(next_interval(0.5, False, 0.5, 30), 1)
+        self.assertEqual(next_interval(20, False, 0.5, 30), 30)
+
+    @override_settings(SITE_ID=1)
+    def test_emit_notices_profile(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "emit.prof")
+        queue([self.user, self.user2], "label")
+        management.call_command("emit_notices", profile=path, stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertTrue(os.path.exists(path))
+        with open(path + ".txt") as fp:
+            self.assertIn("send_all", fp.read())
+        with open(path + ".sql.txt") as fp:
+            self.assertIn('FROM "auth_user" WHERE "auth_user"."id" IN (...)', fp.read())
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            normalize_sql("SELECT * FROM t  WHERE a = 'x''y' AND b IN (1, 2, 3) AND c = 4.5"),
+            "SELECT * FROM t WHERE a = ? AND b IN (...) AND c = ?"
+        )
+        self.assertEqual(
+            normalize_sql('SELECT * FROM "t" WHERE "t"."id" IN (%s, %s,%s) AND "t"."a" = %s'),
+            'SELECT * FROM "t" WHERE "t"."id" IN (...) AND "t"."a" = %s'
+        )
+
+
+class TestLoopConnections(TestCase):
+    def setUp(self):
+        use_temp_directory(self)
+
+    def test_recycle_connections(self):
+        idle, busy = mock.Mock(in_atomic_block=False), mock.Mock(in_atomic_block=True)
+        with mock.patch("pinax.notifications.engine.connections") as connections:
+            connections.all.return_value = [idle, busy]
+            recycle_connections()
+        idle.close_if_unusable_or_obsolete.assert_called_once_with()
+        busy.close_if_unusable_or_obsolete.assert_not_called()
+
+    @override_settings(SITE_ID=1)
+    def test_loop_recycles_connections(self):
+        with mock.patch("pinax.notifications.engine.recycle_connections") as recycle:
+            management.call_command("emit_notices", loop=True, max_seconds=0.1, min_interval=0.05)
+        self.assertTrue(recycle.called)
+
+    def test_listen_after_reconnect(self):
+        connection = mock.MagicMock(vendor="postgresql")
+        cursor = connection.cursor.return_value.__enter__.return_value
+        with mock.patch("pinax.notifications.engine.connections", {"default": connection}):
+            waiter = QueueWaiter()
+            waiter.listen()
+            self.assertEqual(cursor.execute.call_count, 1)
+            # the loop reconnected
+            connection.connection = mock.Mock()
+            waiter.listen()
+        self.assertEqual(
+            cursor.execute.call_args_list, [mock.call("LISTEN pinax_notifications_queue")] * 2)
+
+
+class TestQueuedBatches(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("test_user", "test@user.com", "123456")
+
+    def test_queued_batches(self):
+        for _ in range(3):
+            queue([self.user], "label")
+        first = NoticeQueueBatch.objects.order_by("pk")[0]
+        seen = []
+        with self.assertNumQueries(7):
+            for batch in queued_batches(chunk_size=2):
+                seen.append(batch.pk)
+                if len(seen) == 1:
+                    # deleted by another worker
+                    NoticeQueueBatch.objects.filter(pk=first.pk + 1).delete()
+        self.assertEqual(seen, [first.pk, first.pk + 2])
+
+    def test_queued_during_run(self):
+        queue([self.user], "label")
+        seen = []
+        for batch in queued_batches(chunk_size=1):
+            seen.append(batch.pk)
+            if len(seen) == 1:
+                queue([self.user], "label")
+        self.assertEqual(len(seen), 2)
+
+
+class TestQueueStats(TestCase):
+    def setUp(self):
+        self.users = [get_user_model().objects.create_user("user{0}".format(i)) for i in range(3)]
+
+    @override_settings(PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE=2)
+    def test_queue_stats(self):
+        queue(self.users, "label")
+        queue(self.users[:1], "other", priority=5)
+        queue(Audience("users"), "other")
+        NoticeQueueBatch.objects.filter(label="label").update(
+            created_at=timezone.now() - timedelta(seconds=60))
+        with self.assertNumQueries(3):
+            stats = queue_stats()
+        self.assertEqual(
+            (stats["depth"], stats["recipients"], stats["audiences"]), (4, 4, 1))
+        self.assertGreaterEqual(stats["oldest_age"], 60)
+        self.assertEqual(
+            [(row["label"], row["batches"], row["recipients"]) for row in stats["labels"]],
+            [("label", 2, 3), ("other", 2, 1)]
+        )
+        self.assertEqual(
+            [(row["priority"], row["batches"]) for row in stats["priorities"]], [(0, 3), (5, 1)])
+
+    def test_backfill_legacy_batches(self):
+        migration = import_module("pinax.notifications.migrations.0008_queue_batch_metadata")
+        legacy = [(user.pk, "label", {}, None) for user in self.users]
+        NoticeQueueBatch.objects.create(pickled_data=base64.b64encode(pickle.dumps(legacy)).decode())
+        queue(Audience("users"), "other")
+        NoticeQueueBatch.objects.update(label="", recipient_count=None)
+        migration.backfill_batch_metadata(apps, mock.Mock(connection=connection))
+        stats = queue_stats()
+        self.assertEqual((stats["recipients"], stats["audiences"]), (3, 1))
+        self.assertEqual(
+            [(row["label"], row["batches"], row["recipients"]) for row in stats["labels"]],
+            [("label", 1, 3), ("other", 1, 0)]
+        )
+
+    def test_emit_stats(self):
+        out = StringIO()
+        management.call_command("emit_stats", stdout=out)
+        self.assertIn("0 batches, 0 recipients and 0 audiences queued", out.getvalue())
+        queue(self.users, "label")
+        out = StringIO()
+        management.call_command("emit_stats", json=True, stdout=out)
+        stats = json.loads(out.getvalue())
+        self.assertEqual(stats["labels"][0]["recipients"], 3)
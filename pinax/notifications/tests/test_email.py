@@ -0,0 +1,89 @@
+from unittest import mock
+
+from django.core import mail
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+
+from ..backends.email import EmailBackend
+from ..models import NoticeType
+
+from . import get_backend_id
+
+
+@override_settings(SITE_ID=1)
+class TestEmailBackend(TestCase):
+    def setUp(self):
+        Site.objects.get_current()
+        self.user = get_user_model().objects.create_user("test_user", "test@user.com")
+        NoticeType.create("label", "display", "description")
+        NoticeType.create("text", "display", "description")
+        NoticeType.create("invariant", "display", "description")
+        self.backend = EmailBackend(get_backend_id("email"))
+
+    def deliver(self, label, recipients):
+        notice_type = NoticeType.objects.get(label=label)
+        self.backend.deliver_many(recipients, None, notice_type, {})
+
+    @override_settings(PINAX_NOTIFICATIONS_EMAIL_TEXT_TEMPLATES=True)
+    def test_text_template(self):
+        self.deliver("text", [self.user])
+        self.assertEqual(mail.outbox[0].body, "display for test_user in plain text\n")
+        self.assertEqual(mail.outbox[0].alternatives[0][0], "<p>display for test_user</p>\n")
+
+    @override_settings(PINAX_NOTIFICATIONS_EMAIL_TEXT_TEMPLATES=True)
+    def test_text_template_missing(self):
+        self.deliver("label", [self.user])
+        self.assertEqual(mail.outbox[0].body.strip(), "display for test_user")
+
+    def test_html2text_memoized(self):
+        other = get_user_model().objects.create_user("other", "other@user.com")
+        with mock.patch("pinax.notifications.backends.email.html2text",
+                        return_value="converted") as html2text:
+            self.deliver("label", [self.user, self.user])
+            self.deliver("text", [self.user, other])
+        # the two labels render the same body for the same user
+        self.assertEqual(html2text.call_count, 2)
+        self.assertEqual([message.body for message in mail.outbox], ["converted"] * 4)
+
+    @override_settings(PINAX_NOTIFICATIONS_EMAIL_PLAINTEXT_CACHE_SIZE=0)
+    def test_html2text_not_memoized(self):
+        with mock.patch("pinax.notifications.backends.email.html2text",
+                        return_value="converted") as html2text:
+            self.deliver("label", [self.user, self.user])
+        self.assertEqual(html2text.call_count, 2)
+
+    def count_renders(self, label, recipients):
+        with mock.patch.object(self.backend, "render", wraps=self.backend.render) as render:
+            self.deliver(label, recipients)
+        return render.call_count
+
+    def test_render_once_declared(self):
+        other = get_user_model().objects.create_user("other", "other@user.com")
+        NoticeType.objects.filter(label="invariant").update(recipient_invariant=True)
+        self.assertEqual(self.count_renders("invariant", [self.user, other]), 1)
+        self.assertEqual([message.to for message in mail.outbox], [[self.user.email], [other.email]])
+        self.assertEqual(mail.outbox[1].alternatives[0][0], "<p>display for everybody</p>\n")
+        self.assertEqual(self.count_renders("label", [self.user, other]), 2)
+
+    @override_settings(PINAX_NOTIFICATIONS_EMAIL_DETECT_RECIPIENT_INVARIANT=True)
+    def test_render_once_detected(self):
+        other = get_user_model().objects.create_user("other", "other@user.com")
+        self.assertEqual(self.count_renders("invariant", [self.user, other]), 1)
+        self.assertEqual(self.count_renders("label", [self.user, other]), 2)
+        self.assertEqual(mail.outbox[3].alternatives[0][0], "<p>display for other</p>\n")
+
+    def test_deliver_overridden(self):
+        class HeaderBackend(EmailBackend):
+            def deliver(self, recipient, sender, notice_type, extra_context):
+                message = self.get_message(recipient, sender, notice_type, extra_context)
+                message.extra_headers["X-Notice"] = notice_type.label
+                message.send()
+
+        other = get_user_model().objects.create_user("other", "other@user.com")
+        self.backend = HeaderBackend(get_backend_id("email"))
+        self.deliver("label", [self.user, other])
+        self.assertEqual([message.to for message in mail.outbox], [[self.user.email], [other.email]])
+        self.assertEqual([message.extra_headers["X-Notice"] for message in mail.outbox], ["label"] * 2)
@@ -0,0 +1,97 @@
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from django.test import SimpleTestCase
+
+from .. import lockfile
+from ..lockfile import AlreadyLocked, LockTimeout, NotLocked, FcntlFileLock
+
+
+@unittest.skipIf(lockfile.fcntl is None, "fcntl is not available")
+class TestFcntlFileLock(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "send_notices")
+
+    def test_acquire_release(self):
+        lock = FcntlFileLock(self.path)
+        self.assertFalse(lock.is_locked())
+        lock.acquire(-1)
+        self.assertTrue(lock.i_am_locking())
+        other = FcntlFileLock(self.path)
+        self.assertTrue(other.is_locked())
+        self.assertFalse(other.i_am_locking())
+        with self.assertRaises(AlreadyLocked):
+            other.acquire(-1)
+        lock.release()
+        self.assertFalse(other.is_locked())
+        with self.assertRaises(NotLocked):
+            lock.release()
+
+    def test_timeout(self):
+        lock = FcntlFileLock(self.path)
+        lock.acquire()
+        self.addCleanup(lock.release)
+        start = time.time()
+        with self.assertRaises(LockTimeout):
+            FcntlFileLock(self.path).acquire(0.2)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_blocking_wait(self):
+        lock = FcntlFileLock(self.path)
+        lock.acquire()
+        threading.Timer(0.2, lock.release).start()
+        other = FcntlFileLock(self.path)
+        start = time.time()
+        other.acquire(5)
+        self.assertLess(time.time() - start, 2)
+        other.release()
+
+    def test_timeout_outside_main_thread(self):
+        lock = FcntlFileLock(self.path)
+        lock.acquire()
+        self.addCleanup(lock.release)
+        errors = []
+
+        def acquire():
+            try:
+                FcntlFileLock(self.path).acquire(0.1)
+            except LockTimeout as e:
+                errors.append(e)
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+
+    def test_stale_lock(self):
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                FcntlFileLock(self.path).acquire()
+                os.write(write_end, b"1")
+                time.sleep(30)
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        self.assertEqual(os.read(read_end, 1), b"1")
+        os.close(read_end)
+        lock = FcntlFileLock(self.path)
+        self.assertTrue(lock.is_locked())
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        # the lock file is left behind by the dead process but not held
+        self.assertTrue(os.path.exists(lock.lock_file))
+        lock.acquire(-1)
+        lock.release()
+
+    def test_default(self):
+        if lockfile.sys.platform.startswith("linux"):
+            self.assertIs(lockfile.FileLock, FcntlFileLock)
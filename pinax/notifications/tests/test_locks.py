@@ -0,0 +1,141 @@
+import time
+
+from datetime import timedelta
+from unittest import mock
+
+from django.core import management
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from django.contrib.auth import get_user_model
+
+from ..engine import acquire_lock, emit_batch as engine_emit_batch
+from ..lockfile import AlreadyLocked, LockTimeout
+from ..locks import CacheLock, DatabaseLock, get_lock
+from ..metrics import InMemorySink
+from ..models import NoticeLock, NoticeQueueBatch, NoticeType, queue
+
+
+class LeaseLockTests(object):
+    lock_class = None
+
+    def test_exclusive(self):
+        lock = self.lock_class("send_notices")
+        lock.acquire(-1)
+        other = self.lock_class("send_notices")
+        with self.assertRaises(AlreadyLocked):
+            other.acquire(-1)
+        other.poll_interval = 0.01
+        with self.assertRaises(LockTimeout):
+            other.acquire(0.05)
+        other_name = self.lock_class("other_name")
+        other_name.acquire(-1)
+        self.addCleanup(other_name.release)
+        lock.release()
+        other.acquire(-1)
+        other.release()
+
+    def test_renew(self):
+        lock = self.lock_class("send_notices")
+        lock.acquire(-1)
+        self.assertTrue(lock.renew())
+        lock.release()
+        self.assertFalse(lock.renew())
+
+
+class TestDatabaseLock(LeaseLockTests, TestCase):
+    lock_class = DatabaseLock
+
+    def test_expired_lease(self):
+        lock = DatabaseLock("send_notices")
+        lock.acquire(-1)
+        lock.stopped.set()
+        NoticeLock.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        other = DatabaseLock("send_notices")
+        other.acquire(-1)
+        self.assertEqual(NoticeLock.objects.get().owner, other.owner)
+        self.assertFalse(lock.renew())
+        other.release()
+        self.assertEqual(NoticeLock.objects.count(), 0)
+
+
+class TestCacheLock(LeaseLockTests, TestCase):
+    lock_class = CacheLock
+
+    def setUp(self):
+        cache.clear()
+
+    @override_settings(PINAX_NOTIFICATIONS_LOCK_LEASE=0.3)
+    def test_heartbeat(self):
+        lock = CacheLock("send_notices")
+        lock.acquire(-1)
+        time.sleep(0.6)
+        with self.assertRaises(AlreadyLocked):
+            CacheLock("send_notices").acquire(-1)
+        lock.release()
+        time.sleep(0.4)
+        other = CacheLock("send_notices")
+        other.acquire(-1)
+        other.release()
+
+    def test_renew_taken_over(self):
+        lock = CacheLock("send_notices")
+        lock.acquire(-1)
+        lock.stopped.set()
+
+        def touch(key, timeout):
+            # the lease expired and another host took it after the check
+            lock.cache.set(key, "thief", timeout)
+            return True
+
+        with mock.patch.object(lock.cache, "touch", side_effect=touch, create=True):
+            self.assertFalse(lock.renew())
+        self.assertEqual(lock.cache.get(lock.key), "thief")
+
+
+class TestAcquireLock(TestCase):
+
+    @override_settings(PINAX_NOTIFICATIONS_LOCK_BACKEND="pinax.notifications.locks.DatabaseLock")
+    def test_backend_setting(self):
+        self.assertIsInstance(get_lock("send_notices"), DatabaseLock)
+        lock = acquire_lock()
+        self.assertIsInstance(lock, DatabaseLock)
+        sink = InMemorySink()
+        with override_settings(PINAX_NOTIFICATIONS_METRICS_SINK=sink):
+            self.assertIsNone(acquire_lock())
+        self.assertEqual(
+            sink.count("lock_failures", reason="already_locked", backend="DatabaseLock"), 1)
+        lock.release()
+
+
+@override_settings(
+    SITE_ID=1,
+    PINAX_NOTIFICATIONS_LOCK_BACKEND="pinax.notifications.locks.CacheLock",
+    PINAX_NOTIFICATIONS_LOCK_LEASE=0.3,
+    PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE=1
+)
+class TestLostLock(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = [get_user_model().objects.create_user("user{0}".format(i)) for i in range(3)]
+        NoticeType.create("label", "display", "description")
+
+    def test_stops_when_lease_stolen(self):
+        queue(self.users, "label")
+        emitted = []
+
+        def emit_batch(notices):
+            if not emitted:
+                # another host takes over the lease
+                cache.set("pinax_notifications:lock:send_notices", "thief")
+                time.sleep(0.5)
+            emitted.append(notices)
+            return engine_emit_batch(notices)
+
+        with mock.patch("pinax.notifications.engine.emit_batch", side_effect=emit_batch):
+            management.call_command("emit_notices")
+        self.assertEqual(len(emitted), 1)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 2)
+        self.assertEqual(cache.get("pinax_notifications:lock:send_notices"), "thief")
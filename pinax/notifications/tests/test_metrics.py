@@ -0,0 +1,76 @@
+import os
+import shutil
+import socket
+import tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from django.contrib.auth import get_user_model
+
+from .. import metrics
+from ..metrics import InMemorySink, PrometheusTextfileSink, StatsdSink
+from ..models import NoticeType, send_now
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("test_user", "test@user.com", "123456")
+        NoticeType.create("label", "display", "description")
+
+    def test_disabled(self):
+        self.assertIsNone(metrics.get_sink())
+        self.assertIs(metrics.timer("send_now"), metrics.NULL_TIMER)
+        metrics.incr("delivered")
+
+    @override_settings(SITE_ID=1)
+    def test_send_now_stages(self):
+        sink = InMemorySink()
+        with override_settings(PINAX_NOTIFICATIONS_METRICS_SINK=sink):
+            send_now([self.user], "label")
+        self.assertEqual(sink.count("delivered", label="label", backend="email"), 1)
+        for stage in ["send_now", "activate_language", "can_send", "get_context", "render", "deliver"]:
+            self.assertEqual(len(sink.values(stage, label="label")), 1, stage)
+        self.assertEqual(sink.values("deliver", backend="sms"), [])
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(1)
+        self.addCleanup(server.close)
+        sink = StatsdSink(port=server.getsockname()[1])
+        sink.incr("delivered", tags={"label": "label"})
+        self.assertEqual(server.recv(1024), b"pinax_notifications.delivered.label:1|c")
+        sink = StatsdSink(port=server.getsockname()[1], tags=True)
+        sink.timing("deliver", 0.25, tags={"backend": "email"})
+        self.assertEqual(server.recv(1024), b"pinax_notifications.deliver:250.000|ms|#backend:email")
+
+    def test_prometheus_textfile(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "notifications.prom")
+        sink = PrometheusTextfileSink(path)
+        sink.incr("delivered", tags={"label": "label"})
+        sink.timing("deliver", 0.02, tags={"label": "label"})
+        sink.flush()
+        with open(path) as fp:
+            lines = fp.read().splitlines()
+        self.assertIn('pinax_notifications_delivered_total{label="label"} 1', lines)
+        self.assertIn('pinax_notifications_deliver_seconds_bucket{label="label",le="0.01"} 0', lines)
+        self.assertIn('pinax_notifications_deliver_seconds_bucket{label="label",le="0.05"} 1', lines)
+        self.assertIn('pinax_notifications_deliver_seconds_count{label="label"} 1', lines)
+
+    def test_prometheus_histogram(self):
+        sink = PrometheusTextfileSink(os.devnull)
+        for seconds in (0.01, 0.02, 0.02, 20):
+            sink.timing("deliver", seconds)
+        # no raw samples are kept
+        self.assertEqual(sink.timings, {})
+        lines = sink.render().splitlines()
+        self.assertIn('pinax_notifications_deliver_seconds_bucket{le="0.005"} 0', lines)
+        self.assertIn('pinax_notifications_deliver_seconds_bucket{le="0.01"} 1', lines)
+        self.assertIn('pinax_notifications_deliver_seconds_bucket{le="0.05"} 3', lines)
+        self.assertIn('pinax_notifications_deliver_seconds_bucket{le="10"} 3', lines)
+        self.assertIn('pinax_notifications_deliver_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('pinax_notifications_deliver_seconds_sum 20.05', lines)
+        self.assertIn('pinax_notifications_deliver_seconds_count 4', lines)
@@ -1,7 +1,7 @@
-import base64
+from unittest import mock
 
 from django.core import mail
-from django.utils.six.moves import cPickle as pickle
+from django.core.mail import get_connection
 from django.test import TestCase
 from django.test.utils import override_settings
 
@@ -15,6 +15,7 @@ from ..conf import settings
 from ..models import NoticeType, NoticeQueueBatch, NoticeSetting
 from ..models import LanguageStoreNotAvailable
 from ..models import get_notification_language, send_now, send, queue
+from ..payload import decode_batch
 from ..utils import notice_setting_for_user
 
 from .models import Language
@@ -66,6 +67,29 @@ class TestNoticeType(TestCase):
         self.assertEqual(n.description, "you got an invitation")
         self.assertEqual(n.default, 1)
 
+    def test_create_many(self):
+        NoticeType.create("existing", "Existing", "an existing type")
+        NoticeType.create("unchanged", "Unchanged", "an unchanged type")
+        specs = [
+            ("existing", "Existing", "a changed description"),
+            {"label": "unchanged", "display": "Unchanged", "description": "an unchanged type"},
+        ] + [
+            ("new_{0}".format(i), "New", "a new type", "", 1)
+            for i in range(20)
+        ]
+        # savepoint, select, insert, update, release
+        with self.assertNumQueries(5):
+            counts = NoticeType.create_many(specs, verbosity=2)
+        self.assertEqual(counts, {"created": 20, "updated": 1, "unchanged": 1})
+        self.assertEqual(NoticeType.objects.get(label="existing").description, "a changed description")
+        self.assertEqual(NoticeType.objects.get(label="new_7").default, 1)
+        self.assertEqual(NoticeType.objects.count(), 22)
+
+        # savepoint, select, release
+        with self.assertNumQueries(3):
+            counts = NoticeType.create_many(specs)
+        self.assertEqual(counts, {"created": 0, "updated": 0, "unchanged": 22})
+
 
 class TestNoticeSetting(BaseTest):
     def test_for_user(self):
@@ -126,6 +150,15 @@ class TestProcedures(BaseTest):
         self.assertIn(self.user.email, mail.outbox[0].to)
         self.assertIn(self.user2.email, mail.outbox[1].to)
 
+    @override_settings(SITE_ID=1)
+    def test_send_now_deliver_many(self):
+        with mock.patch("pinax.notifications.backends.email.get_connection",
+                        wraps=get_connection) as connection:
+            self.assertTrue(send_now([self.user, self.user2], "label"))
+        self.assertEqual(connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].alternatives[0][1], "text/html")
+
     @override_settings(SITE_ID=1)
     def test_send(self):
         self.assertRaises(AssertionError, send, queue=True, now=True)
@@ -139,7 +172,7 @@ class TestProcedures(BaseTest):
         send(users, "label", queue=True)
         self.assertEqual(NoticeQueueBatch.objects.count(), 1)
         batch = NoticeQueueBatch.objects.all()[0]
-        notices = pickle.loads(base64.b64decode(batch.pickled_data))
+        notices = decode_batch(batch.pickled_data)
         self.assertEqual(len(notices), 2)
 
     @override_settings(SITE_ID=1)
@@ -156,3 +189,16 @@ class TestProcedures(BaseTest):
         queue(users, "label")
         self.assertEqual(len(mail.outbox), 0)
         self.assertEqual(NoticeQueueBatch.objects.count(), 1)
+
+    @override_settings(SITE_ID=1, PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE=1)
+    def test_queue_batch_size(self):
+        users = get_user_model().objects.all()
+        queue(users, "label")
+        self.assertEqual(NoticeQueueBatch.objects.count(), 2)
+        recipients = []
+        for batch in NoticeQueueBatch.objects.all():
+            notices = decode_batch(batch.pickled_data)
+            self.assertEqual(len(notices), 1)
+            recipients.append(notices[0][0])
+            self.assertEqual((batch.label, batch.recipient_count), ("label", 1))
+        self.assertEqual(sorted(recipients), sorted(users.values_list("pk", flat=True)))
@@ -0,0 +1,82 @@
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from django.contrib.auth import get_user_model
+
+from .. import outbox
+from ..audiences import Audience
+from ..models import NoticeQueueBatch, queue
+from ..payload import decode_batch
+
+
+@override_settings(PINAX_NOTIFICATIONS_QUEUE_OUTBOX=True)
+class TestOutbox(TransactionTestCase):
+    def setUp(self):
+        self.users = [get_user_model().objects.create_user("user{0}".format(i)) for i in range(4)]
+
+    def batches(self):
+        """
+        Returns the label, extra context and recipients of each batch.
+        """
+        batches = []
+        for batch in NoticeQueueBatch.objects.order_by("pk"):
+            notices = decode_batch(batch.pickled_data)
+            batches.append((notices[0][1], notices[0][2], [notice[0] for notice in notices]))
+        return batches
+
+    def test_merged_on_commit(self):
+        with transaction.atomic():
+            queue(self.users[:2], "label", {"a": 1})
+            queue(self.users[2:], "label", {"a": 1})
+            queue(self.users[:1], "other")
+            queue(Audience("users"), "label", {"a": 1})
+            self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+        self.assertEqual(self.batches(), [
+            ("label", {"a": 1}, [user.pk for user in self.users]),
+            ("other", {}, [self.users[0].pk]),
+            ("label", {"a": 1}, [Audience("users")]),
+        ])
+
+    @override_settings(PINAX_NOTIFICATIONS_QUEUE_BATCH_SIZE=3)
+    def test_single_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                for user in self.users:
+                    queue([user], "label")
+        inserts = [query for query in queries if query["sql"].startswith("INSERT")]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual([len(batch[2]) for batch in self.batches()], [3, 1])
+
+    def test_released_savepoint(self):
+        with transaction.atomic():
+            queue(self.users[:1], "label")
+            with transaction.atomic():
+                queue(self.users[1:2], "label")
+            queue(self.users[2:], "label")
+        # one write for the outermost block and one for the savepoint
+        self.assertEqual(self.batches(), [
+            ("label", {}, [self.users[0].pk, self.users[2].pk, self.users[3].pk]),
+            ("label", {}, [self.users[1].pk]),
+        ])
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                queue(self.users, "label")
+                raise ValueError
+        # the outbox went away with its discarded on_commit callback
+        self.assertEqual(len(outbox._local.outboxes), 0)
+        with transaction.atomic():
+            queue(self.users[:1], "label")
+            try:
+                with transaction.atomic():
+                    queue(self.users[1:], "label")
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(self.batches(), [("label", {}, [self.users[0].pk])])
+
+    def test_autocommit(self):
+        queue(self.users, "label")
+        self.assertEqual(NoticeQueueBatch.objects.count(), 1)
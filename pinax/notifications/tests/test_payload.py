@@ -0,0 +1,99 @@
+import base64
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.six.moves import cPickle as pickle
+
+from django.contrib.auth import get_user_model
+
+from ..audiences import Audience
+from ..models import NoticeType
+from ..payload import MAGIC, CODEC_NONE, CODEC_ZLIB, ModelReference
+from ..payload import encode_batch, decode_batch, dehydrate
+
+
+class TestPayload(TestCase):
+
+    def codec(self, data):
+        raw = base64.b64decode(data)
+        self.assertTrue(raw.startswith(MAGIC))
+        return bytearray(raw)[len(MAGIC) + 1]
+
+    def test_roundtrip(self):
+        data = encode_batch([1, 2, 2 ** 40], "label", {"spam": "eggs"}, "sender")
+        self.assertEqual(self.codec(data), CODEC_NONE)
+        self.assertEqual(decode_batch(data), [
+            (1, "label", {"spam": "eggs"}, "sender"),
+            (2, "label", {"spam": "eggs"}, "sender"),
+            (2 ** 40, "label", {"spam": "eggs"}, "sender"),
+        ])
+
+    def test_non_integer_pks(self):
+        data = encode_batch(["a", "b"], "label", {}, None)
+        self.assertEqual([notice[0] for notice in decode_batch(data)], ["a", "b"])
+
+    def test_audience(self):
+        audience = Audience.filter(is_active=True)
+        self.assertEqual(decode_batch(encode_batch(audience, "label", {}, None)),
+                         [(audience, "label", {}, None)])
+
+    @override_settings(PINAX_NOTIFICATIONS_QUEUE_COMPRESSION_THRESHOLD=100)
+    def test_compression(self):
+        recipients = list(range(1000))
+        extra_context = {"body": "lorem ipsum " * 100}
+        data = encode_batch(recipients, "label", extra_context, None)
+        self.assertEqual(self.codec(data), CODEC_ZLIB)
+        legacy = base64.b64encode(pickle.dumps(
+            [(pk, "label", extra_context, None) for pk in recipients]))
+        self.assertLess(len(data) * 5, len(legacy))
+        self.assertEqual(decode_batch(data), [(pk, "label", extra_context, None) for pk in recipients])
+
+        with override_settings(PINAX_NOTIFICATIONS_QUEUE_COMPRESSION=None):
+            data = encode_batch(recipients, "label", extra_context, None)
+        self.assertEqual(self.codec(data), CODEC_NONE)
+
+    def test_legacy_rows(self):
+        notices = [(1, "label", {}, None), (2, "other", {"a": 1}, "sender")]
+        self.assertEqual(decode_batch(base64.b64encode(pickle.dumps(notices))), notices)
+        self.assertEqual(decode_batch(base64.b64encode(pickle.dumps(notices, 0)).decode()), notices)
+
+
+class TestModelReferences(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("test_user", "test@user.com", "123456")
+        self.user2 = get_user_model().objects.create_user("test_user2", "test2@user.com", "123456")
+        self.notice_type = NoticeType.objects.create(
+            label="label", display="display", description="description", default=2)
+
+    def test_dehydrate(self):
+        value = dehydrate({"users": [self.user], "pair": (self.notice_type, 1), "unsaved": NoticeType()})
+        self.assertIsInstance(value["users"][0], ModelReference)
+        self.assertIsInstance(value["pair"][0], ModelReference)
+        self.assertEqual(value["pair"][1], 1)
+        self.assertIsInstance(value["unsaved"], NoticeType)
+
+    def test_rehydrate_in_bulk(self):
+        data = encode_batch(
+            [self.user.pk], "label",
+            {"friends": [self.user, self.user2], "notice_type": self.notice_type}, self.user)
+        get_user_model().objects.filter(pk=self.user.pk).update(first_name="Fresh")
+        with self.assertNumQueries(2):
+            notices = decode_batch(data)
+        _, _, extra_context, sender = notices[0]
+        self.assertEqual(sender, self.user)
+        self.assertEqual(sender.first_name, "Fresh")
+        self.assertEqual(extra_context["friends"], [self.user, self.user2])
+        self.assertIs(extra_context["friends"][0], sender)
+        self.assertEqual(extra_context["notice_type"], self.notice_type)
+
+    def test_deleted_instance(self):
+        data = encode_batch([self.user.pk], "label", {}, self.user2)
+        self.user2.delete()
+        self.assertIsNone(decode_batch(data)[0][3])
+
+    def test_audience_arguments(self):
+        audience = Audience("users", notice_type=self.notice_type)
+        data = encode_batch(audience, "label", {}, None)
+        self.assertNotIn(b"display", base64.b64decode(data))
+        decoded = decode_batch(data)[0][0]
+        self.assertEqual(decoded.kwargs["notice_type"], self.notice_type)
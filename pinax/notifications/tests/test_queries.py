@@ -0,0 +1,126 @@
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
+
+from ..engine import emit_queued
+from ..models import NoticeType, NoticeSetting, queue, send_now
+from ..utils import notice_setting_for_user
+from ..views import NoticeSettingsView
+
+from . import QueryBudgetMixin, create_users, get_backend_id
+
+
+@override_settings(SITE_ID=1)
+class TestSendNowQueries(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        NoticeType.create("label", "display", "description")
+        self.notice_type = NoticeType.objects.get(label="label")
+        Site.objects.get_current()
+
+    def seed_settings(self, users):
+        NoticeSetting.objects.bulk_create([
+            NoticeSetting(user=user, notice_type=self.notice_type,
+                          medium=get_backend_id("email"), send=True)
+            for user in users
+        ])
+
+    def test_send_now_with_settings(self):
+        small, large = create_users("small", 1), create_users("large", 500)
+        self.seed_settings(small + large)
+        count = self.assertConstantQueries(
+            lambda: send_now(small, "label"),
+            lambda: send_now(large, "label"))
+        self.assertLessEqual(count, 2)
+        self.assertEqual(len(mail.outbox), 501)
+
+    def test_send_now_creates_defaults(self):
+        small, large = create_users("small", 1), create_users("large", 100)
+        count = self.assertConstantQueries(
+            lambda: send_now(small, "label"),
+            lambda: send_now(large, "label"))
+        # notice type, settings, savepoint, insert, release, settings
+        self.assertLessEqual(count, 6)
+        self.assertEqual(NoticeSetting.objects.count(), 101)
+        self.assertEqual(len(mail.outbox), 101)
+
+    def test_emit_queued(self):
+        small, large = create_users("small", 1), create_users("large", 500)
+        self.seed_settings(small + large)
+
+        def emit(users):
+            queue(users, "label")
+            emit_queued()
+
+        self.assertConstantQueries(lambda: emit(small), lambda: emit(large))
+        self.assertEqual(len(mail.outbox), 501)
+
+
+class TestNoticeSettingForUserQueries(TestCase):
+    def setUp(self):
+        self.user = create_users("user", 1)[0]
+        NoticeType.create("label", "display", "description")
+        self.notice_type = NoticeType.objects.get(label="label")
+
+    def test_notice_setting_for_user(self):
+        email_id = get_backend_id("email")
+        with self.assertNumQueries(2):
+            notice_setting_for_user(self.user, self.notice_type, email_id)
+        with self.assertNumQueries(1):
+            notice_setting_for_user(self.user, self.notice_type, email_id)
+
+
+class TestNoticeSettingsViewQueries(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = create_users("user", 1)[0]
+
+    def create_types(self, count):
+        NoticeType.objects.all().delete()
+        for i in range(count):
+            NoticeType.create("label_{0}".format(i), "display", "description")
+        return list(NoticeType.objects.all())
+
+    def get(self):
+        request = self.factory.get("/notifications/settings/")
+        request.user = self.user
+        NoticeSettingsView.as_view()(request).render()
+
+    def post(self):
+        data = dict(
+            ("setting-{0}-{1}".format(notice_type.pk, get_backend_id("email")), "on")
+            for notice_type in NoticeType.objects.all()[::2]
+        )
+        request = self.factory.post("/notifications/settings/", data)
+        request.user = self.user
+        NoticeSettingsView.as_view()(request)
+
+    def test_get(self):
+        def run(count):
+            self.create_types(count)
+            return self.capture(self.get)
+
+        cold = [len(run(5)), len(run(50))]
+        self.assertEqual(cold[0], cold[1])
+        # notice types, settings, savepoint, insert, release, settings
+        self.assertLessEqual(cold[0], 6)
+
+        self.create_types(5)
+        self.get()
+        small = self.capture(self.get)
+        self.create_types(50)
+        self.get()
+        large = self.capture(self.get)
+        self.assertEqual(len(small), len(large), "\n".join(q["sql"] for q in large))
+        self.assertLessEqual(len(large), 2)
+
+    def test_post(self):
+        self.create_types(5)
+        self.get()
+        small = self.capture(self.post)
+        self.create_types(50)
+        self.get()
+        large = self.capture(self.post)
+        self.assertEqual(len(small), len(large), "\n".join(q["sql"] for q in large))
+        self.assertLessEqual(len(large), 4)
+        self.assertEqual(NoticeSetting.objects.filter(send=False).count(), 25)
@@ -0,0 +1,66 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.core import mail
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+
+from ..backends.sink import SinkBackend
+from ..models import NoticeType, NoticeSetting
+
+from . import get_backend_id
+
+
+@override_settings(SITE_ID=1)
+class TestSinkBackend(TestCase):
+    def setUp(self):
+        Site.objects.get_current()
+        self.users = [
+            get_user_model().objects.create_user("user{0}".format(i), "user{0}@user.com".format(i))
+            for i in range(5)
+        ]
+        NoticeType.create("label", "display", "description")
+        self.notice_type = NoticeType.objects.get(label="label")
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @override_settings(PINAX_NOTIFICATIONS_SINK_OPTIONS={"ring_size": 3})
+    def test_ring_buffer(self):
+        backend = SinkBackend(get_backend_id("email"))
+        backend.deliver_many(self.users, None, self.notice_type, {})
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual([m["to"] for m in backend.messages],
+                         [[user.email] for user in self.users[2:]])
+        self.assertEqual(backend.messages[0]["subject"], "display")
+        self.assertEqual(backend.stats()["messages"], 5)
+
+    def test_can_send(self):
+        backend = SinkBackend(get_backend_id("email"))
+        user = get_user_model().objects.create_user("noemail")
+        self.assertTrue(backend.can_send(user, self.notice_type, None))
+        NoticeSetting.objects.filter(user=user, medium=get_backend_id("email")).update(send=False)
+        self.assertFalse(backend.can_send(user, self.notice_type, None))
+
+    def test_rotating_file(self):
+        path = os.path.join(self.tmpdir, "notices.jsonl")
+        backend = SinkBackend(get_backend_id("email"))
+        with self.settings(PINAX_NOTIFICATIONS_SINK_OPTIONS={
+                "path": path, "max_bytes": 1, "backup_count": 2}):
+            for user in self.users:
+                backend.deliver(user, None, self.notice_type, {})
+        backend.close()
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ["notices.jsonl", "notices.jsonl.1", "notices.jsonl.2"])
+        with open(path) as fp:
+            self.assertEqual(json.loads(fp.read())["to"], [self.users[-1].email])
+        stats = backend.stats()
+        self.assertEqual(stats["messages"], 5)
+        self.assertGreater(stats["bytes"], 0)
+        self.assertIn("5 messages", backend.report())
@@ -0,0 +1,64 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+
+from ..backends.stored import StoredBackend
+from ..models import NoticeType, StoredNotice, NoticeCounter
+
+from . import QueryBudgetMixin, create_users, get_backend_id
+
+
+@override_settings(SITE_ID=1)
+class TestStoredBackend(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        Site.objects.get_current()
+        self.users = create_users("user", 3)
+        self.sender = get_user_model().objects.create_user("sender")
+        NoticeType.create("label", "display", "description")
+        self.notice_type = NoticeType.objects.get(label="label")
+        self.backend = StoredBackend(get_backend_id("email"))
+
+    def deliver(self, recipients):
+        self.backend.deliver_many(recipients, self.sender, self.notice_type, {})
+
+    def test_deliver_many(self):
+        self.deliver(self.users)
+        self.deliver(self.users[:1] * 2)
+        self.assertEqual([StoredNotice.unread_count(user) for user in self.users], [3, 1, 1])
+        notice = StoredNotice.for_user(self.users[1])[0]
+        self.assertEqual(notice.message, "display\n")
+        self.assertEqual(notice.sender, self.sender)
+        self.assertEqual(StoredNotice.unread_count(self.sender), 0)
+
+    def test_constant_queries(self):
+        small, large = create_users("small", 1), create_users("large", 50)
+        self.assertConstantQueries(lambda: self.deliver(small), lambda: self.deliver(large))
+        self.assertConstantQueries(lambda: self.deliver(small), lambda: self.deliver(large))
+        self.assertEqual(NoticeCounter.objects.filter(unread=2).count(), 51)
+
+    def test_keyset_pagination(self):
+        user = self.users[0]
+        for i in range(5):
+            self.deliver([user])
+        first = StoredNotice.for_user(user, limit=2)
+        second = StoredNotice.for_user(user, before=first[-1].pk, limit=2)
+        third = StoredNotice.for_user(user, before=second[-1].pk, limit=2)
+        pks = [notice.pk for notice in first + second + third]
+        self.assertEqual(pks, sorted(pks, reverse=True))
+        self.assertEqual(len(set(pks)), 5)
+
+    def test_mark_read(self):
+        user = self.users[0]
+        for i in range(4):
+            self.deliver([user])
+        notices = StoredNotice.for_user(user)
+        self.assertEqual(StoredNotice.mark_read(user, [notices[0].pk, notices[1].pk]), 2)
+        self.assertEqual(StoredNotice.mark_read(user, [notices[0].pk]), 0)
+        self.assertEqual(StoredNotice.unread_count(user), 2)
+        self.assertEqual(len(StoredNotice.for_user(user, unread=True)), 2)
+        notices[2].delete()
+        self.assertEqual(StoredNotice.unread_count(user), 1)
+        self.assertEqual(StoredNotice.mark_read(user), 1)
+        self.assertEqual(StoredNotice.unread_count(user), 0)
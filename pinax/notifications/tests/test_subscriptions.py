@@ -0,0 +1,91 @@
+from django.core import management, mail
+from django.db.models.query import QuerySet
+from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
+
+from django.contrib.auth import get_user_model
+
+from ..audiences import Audience, subscribers
+from ..models import NoticeType, NoticeSetting, NoticeSubscriptionIndex, send_now
+from ..subscriptions import set_bit, test_bit, subscriptions_for_users
+from ..utils import load_media_defaults
+from ..views import NoticeSettingsView
+
+from . import get_backend_id
+
+
+class TestBits(TestCase):
+
+    def test_set_bit(self):
+        bits = bytearray()
+        set_bit(bits, 9, True)
+        self.assertEqual(bits, bytearray([0, 2]))
+        self.assertTrue(test_bit(bits, 9))
+        self.assertFalse(test_bit(bits, 8))
+        self.assertFalse(test_bit(bits, 100))
+        set_bit(bits, 9, False)
+        set_bit(bits, 100, False)
+        self.assertEqual(bits, bytearray([0, 0]))
+
+
+@override_settings(SITE_ID=1, PINAX_NOTIFICATIONS_SUBSCRIPTION_INDEX=True)
+class TestSubscriptionIndex(TestCase):
+    def setUp(self):
+        self.users = [
+            get_user_model().objects.create_user("user{0}".format(i), "user{0}@user.com".format(i))
+            for i in range(3)
+        ]
+        NoticeType.create("label", "display", "description")
+        NoticeType.create("off", "display", "description", default=1)
+        self.notice_type = NoticeType.objects.get(label="label")
+        self.off = NoticeType.objects.get(label="off")
+        self.medium = get_backend_id("email")
+
+    def subscribed(self, user, notice_type):
+        _, defaults = load_media_defaults()
+        return subscriptions_for_users(
+            [user.pk], [notice_type], [self.medium], defaults)[(user.pk, notice_type.pk, self.medium)]
+
+    def test_follows_settings(self):
+        user = self.users[0]
+        self.assertTrue(self.subscribed(user, self.notice_type))
+        self.assertFalse(self.subscribed(user, self.off))
+
+        setting = NoticeSetting.objects.create(
+            user=user, notice_type=self.notice_type, medium=self.medium, send=False)
+        NoticeSetting.objects.create(user=user, notice_type=self.off, medium=self.medium, send=True)
+        self.assertFalse(self.subscribed(user, self.notice_type))
+        self.assertTrue(self.subscribed(user, self.off))
+        self.assertEqual(NoticeSubscriptionIndex.objects.count(), 1)
+
+        setting.delete()
+        self.assertTrue(self.subscribed(user, self.notice_type))
+
+    def test_settings_view(self):
+        user = self.users[0]
+        request = RequestFactory().post("/settings/", {})
+        request.user = user
+        NoticeSettingsView.as_view()(request)
+        self.assertFalse(self.subscribed(user, self.notice_type))
+
+    def test_rebuild(self):
+        NoticeSetting.objects.bulk_create([
+            NoticeSetting(user=user, notice_type=self.notice_type, medium=self.medium, send=False)
+            for user in self.users[:2]
+        ])
+        self.assertTrue(self.subscribed(self.users[0], self.notice_type))
+        management.call_command("rebuild_subscription_index", chunk_size=2)
+        self.assertEqual(
+            [self.subscribed(user, self.notice_type) for user in self.users], [False, False, True])
+
+    def test_send_and_audience(self):
+        NoticeSetting.objects.create(
+            user=self.users[0], notice_type=self.notice_type, medium=self.medium, send=False)
+        with self.assertNumQueries(2):
+            # the notice type and the subscription index
+            send_now(self.users, "label")
+        self.assertEqual([m.to[0] for m in mail.outbox], [user.email for user in self.users[1:]])
+        self.assertEqual(NoticeSetting.objects.count(), 1)
+        self.assertEqual(list(Audience.subscribers("label", self.medium)), self.users[1:])
+        # selected in SQL rather than by scanning the index of every user
+        self.assertIsInstance(subscribers("label", self.medium), QuerySet)
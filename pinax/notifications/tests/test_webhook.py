@@ -0,0 +1,131 @@
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+
+from ..backends.webhook import WebhookBackend, WebhookError
+from ..models import NoticeType
+
+from . import get_backend_id
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        status = server.statuses.pop(0) if server.statuses else 200
+        if status == 200:
+            server.requests.append((self.client_address, json.loads(body.decode("utf-8"))))
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        # hang up without telling the client, like an idle timeout would
+        self.close_connection = server.hang_up
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@override_settings(SITE_ID=1)
+class TestWebhookBackend(TestCase):
+    def setUp(self):
+        Site.objects.get_current()
+        self.users = [
+            get_user_model().objects.create_user("user{0}".format(i), "user{0}@user.com".format(i))
+            for i in range(5)
+        ]
+        NoticeType.create("label", "display", "description")
+        self.notice_type = NoticeType.objects.get(label="label")
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.requests = []
+        self.server.statuses = []
+        self.server.hang_up = False
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def backend(self, **options):
+        options.setdefault("url", "http://127.0.0.1:{0}/hook".format(self.server.server_port))
+        options.setdefault("backoff", 0)
+        backend = WebhookBackend(get_backend_id("email"))
+        backend.options = options
+        self.addCleanup(backend.pool.close)
+        return backend
+
+    def test_batches_over_one_connection(self):
+        backend = self.backend(batch_size=2)
+        backend.deliver_many(self.users, None, self.notice_type, {})
+        self.assertEqual([len(body["notices"]) for _, body in self.server.requests], [2, 2, 1])
+        self.assertEqual(len(set(address for address, _ in self.server.requests)), 1)
+        notice = self.server.requests[0][1]["notices"][0]
+        self.assertEqual(notice["recipient"], self.users[0].pk)
+        self.assertEqual(notice["messages"]["short.txt"], "display")
+
+    def test_flush_interval(self):
+        backend = self.backend(batch_size=10, flush_interval=50)
+        backend.deliver(self.users[0], None, self.notice_type, {})
+        backend.deliver(self.users[1], None, self.notice_type, {})
+        self.assertEqual(self.server.requests, [])
+        deadline = time.time() + 5
+        while not self.server.requests and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.server.requests[0][1]["notices"]), 2)
+
+    def test_retries(self):
+        self.server.statuses = [503, 503]
+        backend = self.backend(retries=2)
+        backend.deliver(self.users[0], None, self.notice_type, {})
+        self.assertEqual(len(self.server.requests), 1)
+
+        self.server.statuses = [503, 503, 503]
+        with self.assertRaises(WebhookError):
+            backend.deliver(self.users[0], None, self.notice_type, {})
+
+        self.server.statuses = [400]
+        with self.assertRaises(WebhookError):
+            backend.deliver(self.users[0], None, self.notice_type, {})
+        self.assertEqual(self.server.statuses, [])
+
+    def test_stale_connection(self):
+        self.server.hang_up = True
+        backend = self.backend(retries=0)
+        backend.deliver(self.users[0], None, self.notice_type, {})
+        backend.deliver(self.users[1], None, self.notice_type, {})
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(set(address for address, _ in self.server.requests)), 2)
+
+    def test_flush_interval_failure(self):
+        self.server.statuses = [503]
+        backend = self.backend(retries=0, flush_interval=10)
+        backend.deliver(self.users[0], None, self.notice_type, {})
+        deadline = time.time() + 5
+        while not backend.failed and time.time() < deadline:
+            time.sleep(0.01)
+        # kept instead of dropped, and retried by the next delivery
+        self.assertEqual([notice["recipient"] for notice in backend.pending], [self.users[0].pk])
+        self.server.statuses = [503]
+        with self.assertRaises(WebhookError):
+            backend.deliver(self.users[1], None, self.notice_type, {})
+        self.assertEqual([notice["recipient"] for notice in backend.pending], [self.users[0].pk])
+        backend.flush()
+        self.assertEqual(self.server.requests[0][1]["notices"][0]["recipient"], self.users[0].pk)
+        self.assertEqual(backend.pending, [])
+        self.assertFalse(backend.failed)
@@ -1,8 +1,19 @@
+import threading
+
+from contextlib import contextmanager
+from itertools import islice
+
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError, transaction
 
 from django.contrib.contenttypes.models import ContentType
 
+from .cache import get_preference_cache
 from .conf import settings
+from .subscriptions import index_enabled, refresh_index, subscriptions_for_users
+
+
+_prefetched = threading.local()
 
 
 def load_media_defaults():
@@ -15,10 +26,229 @@ def load_media_defaults():
     return media, defaults
 
 
+def chunked(iterable, size):
+    """
+    Yields lists of at most ``size`` items from ``iterable``.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def scoping_key(scoping):
+    if not scoping:
+        return None
+    return (ContentType.objects.get_for_model(scoping).pk, scoping.pk)
+
+
+def _scoping_kwargs(scoping):
+    """
+    Returns the field values and the lookup matching ``scoping``.
+    """
+    if scoping:
+        values = {
+            "scoping_content_type": ContentType.objects.get_for_model(scoping),
+            "scoping_object_id": scoping.pk
+        }
+        return values, dict(values)
+    values = {
+        "scoping_content_type": None,
+        "scoping_object_id": None
+    }
+    return values, {
+        "scoping_content_type__isnull": True,
+        "scoping_object_id__isnull": True
+    }
+
+
+def _fetch_notice_settings(pairs, media, scoping):
+    """
+    Loads the settings of ``(user, notice_type)`` pairs from the database,
+    creating the missing default settings in bulk.
+    """
+    from .models import NoticeSetting
+
+    scoping_values, scoping_lookup = _scoping_kwargs(scoping)
+    queryset = NoticeSetting.objects.filter(
+        user__in=set(user.pk for user, _ in pairs),
+        notice_type__in=set(notice_type.pk for _, notice_type in pairs),
+        medium__in=media,
+        **scoping_lookup
+    )
+
+    def fetch():
+        return dict(
+            ((setting.user_id, setting.notice_type_id, setting.medium), setting)
+            for setting in queryset.all()
+        )
+    found = fetch()
+
+    _, NOTICE_MEDIA_DEFAULTS = load_media_defaults()
+    missing = [
+        NoticeSetting(
+            user=user,
+            notice_type=notice_type,
+            medium=medium,
+            send=(NOTICE_MEDIA_DEFAULTS[medium] <= notice_type.default),
+            **scoping_values
+        )
+        for user, notice_type in pairs
+        for medium in media
+        if (user.pk, notice_type.pk, medium) not in found
+    ]
+    if missing:
+        try:
+            with transaction.atomic():
+                NoticeSetting.objects.bulk_create(missing)
+        except IntegrityError:
+            # somebody else created some of them concurrently
+            for setting in missing:
+                NoticeSetting.objects.get_or_create(
+                    user=setting.user,
+                    notice_type=setting.notice_type,
+                    medium=setting.medium,
+                    defaults={"send": setting.send},
+                    **scoping_values
+                )
+        # bulk_create does not set primary keys on every database
+        found = fetch()
+        # nor does it send post_save
+        if scoping is None:
+            refresh_index(set(setting.user_id for setting in missing))
+
+    return dict(
+        ((user.pk, notice_type.pk, medium), found[(user.pk, notice_type.pk, medium)])
+        for user, notice_type in pairs
+        for medium in media
+    )
+
+
+def notice_settings_for_users(users, notice_types, media, scoping=None):
+    """
+    Resolves the settings of every user for every notice type and medium in
+    a constant number of queries, creating the missing default settings in
+    bulk. When the preference cache is enabled, settings are read from it
+    first and only the misses go to the database.
+
+    Returns a dict keyed by ``(user.pk, notice_type.pk, medium)``. Users
+    lacking a notice type's permission have no entry for it.
+    """
+    from .models import NoticeSetting
+
+    allowed = [
+        (user, notice_type)
+        for user in users
+        for notice_type in notice_types
+        if not notice_type.permission or user.has_perm(notice_type.permission)
+    ]
+    if not allowed or not media:
+        return {}
+
+    preference_cache = get_preference_cache()
+    if preference_cache is None:
+        return _fetch_notice_settings(allowed, media, scoping)
+
+    key = scoping_key(scoping)
+    scoping_values, _ = _scoping_kwargs(scoping)
+    versions, maps = preference_cache.get_many(list(set(user.pk for user, _ in allowed)))
+    resolved, remaining = {}, []
+    for user, notice_type in allowed:
+        user_map = maps.get(user.pk, {})
+        entries = [user_map.get((notice_type.pk, medium, key)) for medium in media]
+        if None in entries:
+            remaining.append((user, notice_type))
+            continue
+        for medium, (pk, send) in zip(media, entries):
+            resolved[(user.pk, notice_type.pk, medium)] = NoticeSetting(
+                pk=pk,
+                user=user,
+                notice_type=notice_type,
+                medium=medium,
+                send=send,
+                **scoping_values
+            )
+
+    if remaining:
+        fetched = _fetch_notice_settings(remaining, media, scoping)
+        resolved.update(fetched)
+        updated = {}
+        for (user_pk, notice_type_pk, medium), setting in fetched.items():
+            if user_pk not in updated:
+                updated[user_pk] = dict(maps.get(user_pk, {}))
+            updated[user_pk][(notice_type_pk, medium, key)] = (setting.pk, setting.send)
+        preference_cache.set_many(versions, updated)
+    return resolved
+
+
+def indexed_notice_settings(users, notice_types, media):
+    """
+    Like ``notice_settings_for_users`` for unscoped settings, but read from
+    the subscription index with one query. The settings returned are not
+    saved and no default settings are created.
+    """
+    from .models import NoticeSetting
+
+    allowed = dict(
+        ((user.pk, notice_type.pk), (user, notice_type))
+        for user in users
+        for notice_type in notice_types
+        if not notice_type.permission or user.has_perm(notice_type.permission)
+    )
+    if not allowed or not media:
+        return {}
+    _, defaults = load_media_defaults()
+    subscribed = subscriptions_for_users(
+        list(set(user.pk for user, _ in allowed.values())), notice_types, media, defaults)
+    return dict(
+        ((user_pk, notice_type_pk, medium), NoticeSetting(
+            user=allowed[(user_pk, notice_type_pk)][0],
+            notice_type=allowed[(user_pk, notice_type_pk)][1],
+            medium=medium,
+            send=send
+        ))
+        for (user_pk, notice_type_pk, medium), send in subscribed.items()
+        if (user_pk, notice_type_pk) in allowed
+    )
+
+
+@contextmanager
+def prefetch_notice_settings(users, notice_type, media, scoping=None):
+    """
+    Resolves the settings of ``users`` for ``notice_type`` up front so that
+    ``notice_setting_for_user`` (and therefore ``can_send``) does not query
+    the database per user within the block.
+    """
+    key = scoping_key(scoping)
+    if scoping is None and index_enabled():
+        resolved = indexed_notice_settings(users, [notice_type], media)
+    else:
+        resolved = notice_settings_for_users(users, [notice_type], media, scoping)
+    previous = getattr(_prefetched, "settings", None)
+    current = dict(previous or {})
+    for user in users:
+        for medium in media:
+            current[(user.pk, notice_type.pk, medium, key)] = resolved.get(
+                (user.pk, notice_type.pk, medium))
+    _prefetched.settings = current
+    try:
+        yield
+    finally:
+        _prefetched.settings = previous
+
+
 def notice_setting_for_user(user, notice_type, medium, scoping=None):
     """
     @@@ candidate for overriding via a hookset method so you can customize lookup at site level
     """
+    prefetched = getattr(_prefetched, "settings", None)
+    if prefetched:
+        key = (user.pk, notice_type.pk, medium, scoping_key(scoping))
+        if key in prefetched:
+            return prefetched[key]
+
     if notice_type.permission and not user.has_perm(notice_type.permission):
         return None
 
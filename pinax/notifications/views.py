@@ -3,9 +3,11 @@ from django.utils.decorators import method_decorator
 from django.views.generic import TemplateView
 from django.utils.functional import cached_property
 
+from .cache import invalidate_preferences
 from .compat import login_required
-from .models import NoticeType, NOTICE_MEDIA
-from .utils import notice_setting_for_user
+from .models import NoticeType, NoticeSetting, NOTICE_MEDIA
+from .subscriptions import refresh_index
+from .utils import notice_setting_for_user, notice_settings_for_users
 
 
 class NoticeSettingsView(TemplateView):
@@ -16,6 +18,23 @@ class NoticeSettingsView(TemplateView):
         return [notice for notice in NoticeType.objects.all()
                 if not notice.permission or self.request.user.has_perm(notice.permission)]
 
+    @cached_property
+    def notice_types_by_pk(self):
+        return dict((str(notice_type.pk), notice_type) for notice_type in self.notice_types)
+
+    @cached_property
+    def notice_settings(self):
+        """
+        All of the user's settings for the listed notice types, resolved in a
+        constant number of queries.
+        """
+        return notice_settings_for_users(
+            [self.request.user],
+            self.notice_types,
+            [medium_id for medium_id, _ in NOTICE_MEDIA],
+            scoping=self.scoping
+        )
+
     @method_decorator(login_required)
     def dispatch(self, *args, **kwargs):
         return super(NoticeSettingsView, self).dispatch(*args, **kwargs)
@@ -25,6 +44,9 @@ class NoticeSettingsView(TemplateView):
         return None
 
     def setting_for_user(self, notice_type, medium_id):
+        key = (self.request.user.pk, notice_type.pk, medium_id)
+        if key in self.notice_settings:
+            return self.notice_settings[key]
         return notice_setting_for_user(
             self.request.user,
             notice_type,
@@ -39,16 +61,20 @@ class NoticeSettingsView(TemplateView):
         )
 
     def process_cell(self, label):
+        """
+        Applies the posted value of a cell to its setting and returns the
+        setting; saving is left to ``post`` so changes are written in bulk.
+        """
         val = self.request.POST.get(label)
         _, pk, medium_id = label.split("-")
-        notice_type = NoticeType.objects.get(pk=pk)
+        notice_type = self.notice_types_by_pk[pk]
         setting = self.setting_for_user(notice_type, medium_id)
         if setting:
             if val == "on":
                 setting.send = True
             else:
                 setting.send = False
-            setting.save()
+        return setting
 
     def settings_table(self):
         table = []
@@ -66,9 +92,19 @@ class NoticeSettingsView(TemplateView):
 
     def post(self, request, *args, **kwargs):
         table = self.settings_table()
+        changed = {True: [], False: []}
         for row in table:
-            for cell in row["cells"]:
-                self.process_cell(cell[0])
+            for label, send in row["cells"]:
+                setting = self.process_cell(label)
+                if setting and setting.send != send:
+                    changed[setting.send].append(setting.pk)
+        for send, pks in changed.items():
+            if pks:
+                NoticeSetting.objects.filter(pk__in=pks).update(send=send)
+        if changed[True] or changed[False]:
+            # update() does not send post_save
+            invalidate_preferences(request.user.pk)
+            refresh_index([request.user.pk])
         return HttpResponseRedirect(request.POST.get("next_page", "."))
 
     def get_context_data(self, **kwargs):